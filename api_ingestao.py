@@ -0,0 +1,398 @@
+"""API HTTP de ingestão de produtos e movimentações.
+
+Serviço leve para leitores de código de barras e integração com o ERP.
+As requisições entram em uma fila limitada e um único gravador agrupa
+vários lotes em uma só transação (commit agrupado), reutilizando a
+camada de dados do database_standalone.
+
+Endpoints:
+    POST /produtos        {"itens": [{"codigo", "nome", "valor", "filial_id"}, ...]}
+    POST /movimentacoes   {"itens": [{"produto_id" ou "codigo", "filial_id", "tipo",
+                                      "quantidade", "setor", "observacao", "data_movimentacao",
+                                      "custo_unitario"}, ...]}
+    GET  /saude
+
+O cabeçalho Idempotency-Key torna o reenvio de um lote seguro: a
+mesma chave devolve os ids da primeira gravação sem duplicar dados.
+Com a fila cheia o serviço responde 503 com Retry-After.
+Datas sem fuso são lidas no FUSO_HORARIO (padrão America/Cuiaba).
+
+Uso:
+    python api_ingestao.py servir --porta 8600
+    python api_ingestao.py carga --url http://localhost:8600 --produto-id <uuid> --filial 1
+"""
+import argparse
+import json
+import math
+import queue
+import threading
+import time
+import uuid
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+from sqlalchemy.exc import DataError, IntegrityError
+from estatisticas import percentil
+
+# Carregar variáveis de ambiente antes de importar a camada de dados
+load_dotenv()
+
+from database_standalone import (
+    init_database, iniciar_listener, gravar_lotes, limpar_chaves_idempotencia,
+    get_produto_por_id, get_produto_por_codigo, FUSO_HORARIO
+)
+
+# Limites de uma requisição
+MAX_ITENS_REQUISICAO = 5000
+MAX_BYTES_REQUISICAO = 10 * 1024 * 1024
+
+# Respostas recentes por chave de idempotência (evita reenfileirar reenvios)
+MAX_RESPOSTAS_RECENTES = 10000
+_respostas_recentes = OrderedDict()
+_respostas_lock = threading.Lock()
+
+_fila = None
+_config = {}
+
+
+class ErroValidacao(ValueError):
+    """Erro nos dados enviados pelo cliente"""
+
+
+# Falhas causadas pelo conteúdo do lote: reenviar o mesmo lote não adianta
+ERROS_DE_DADOS = (IntegrityError, DataError, ValueError)
+
+
+class Tarefa:
+    """Lote aguardando gravação pelo gravador"""
+
+    def __init__(self, tipo, itens, chave):
+        self.tipo = tipo
+        self.itens = itens
+        self.chave = chave
+        self.resultado = None
+        self.concluida = threading.Event()
+
+
+def _validar_produto(item):
+    """Valida e normaliza um produto recebido"""
+    codigo = str(item.get('codigo') or '').strip()
+    nome = str(item.get('nome') or '').strip()
+    if not codigo or not nome:
+        raise ErroValidacao("codigo e nome são obrigatórios")
+    try:
+        valor = float(item['valor'])
+        filial_id = int(item['filial_id'])
+    except (KeyError, TypeError, ValueError):
+        raise ErroValidacao(f"Produto {codigo}: valor e filial_id são obrigatórios")
+    # json.loads aceita NaN e Infinity, que não cabem no DECIMAL nem no custo médio
+    if not math.isfinite(valor):
+        raise ErroValidacao(f"Produto {codigo}: valor deve ser um número finito")
+    if valor <= 0:
+        raise ErroValidacao(f"Produto {codigo}: valor deve ser maior que zero")
+    return {'codigo': codigo, 'nome': nome, 'valor': valor, 'filial_id': filial_id}
+
+
+def _validar_movimentacao(item):
+    """Valida uma movimentação recebida e resolve o produto pelo catálogo em memória"""
+    if item.get('tipo') not in ('Entrada', 'Saída'):
+        raise ErroValidacao("tipo deve ser 'Entrada' ou 'Saída'")
+    try:
+        quantidade = int(item['quantidade'])
+    except (KeyError, TypeError, ValueError):
+        raise ErroValidacao("quantidade é obrigatória")
+    if quantidade <= 0:
+        raise ErroValidacao("quantidade deve ser maior que zero")
+    setor = str(item.get('setor') or '').strip()
+    if not setor:
+        raise ErroValidacao("setor é obrigatório")
+
+    filial_id = None
+    if item.get('filial_id') is not None:
+        try:
+            filial_id = int(item['filial_id'])
+        except (TypeError, ValueError):
+            raise ErroValidacao("filial_id deve ser numérico")
+
+    if item.get('produto_id'):
+        produto = get_produto_por_id(item['produto_id'])
+    elif item.get('codigo') and filial_id is not None:
+        produto = get_produto_por_codigo(str(item['codigo']), filial_id)
+    else:
+        raise ErroValidacao("informe produto_id ou codigo e filial_id")
+    if not produto:
+        raise ErroValidacao(f"Produto não encontrado: {item.get('produto_id') or item.get('codigo')}")
+    if filial_id is not None and filial_id != produto['filial_id']:
+        raise ErroValidacao(f"Produto {produto['codigo']} não pertence à filial {item['filial_id']}")
+
+    custo_unitario = None
+    if item.get('custo_unitario') is not None:
+        try:
+            custo_unitario = float(item['custo_unitario'])
+        except (TypeError, ValueError):
+            raise ErroValidacao("custo_unitario deve ser numérico")
+        if not math.isfinite(custo_unitario):
+            raise ErroValidacao("custo_unitario deve ser um número finito")
+        if custo_unitario < 0:
+            raise ErroValidacao("custo_unitario não pode ser negativo")
+
+    data_movimentacao = None
+    if item.get('data_movimentacao'):
+        try:
+            data_movimentacao = datetime.fromisoformat(item['data_movimentacao'])
+        except (TypeError, ValueError):
+            raise ErroValidacao("data_movimentacao deve estar no formato ISO 8601")
+        if data_movimentacao.tzinfo is not None:
+            # Datas com fuso viram o horário local usado pelas sessões do banco
+            data_movimentacao = data_movimentacao.astimezone(ZoneInfo(FUSO_HORARIO)).replace(tzinfo=None)
+
+    return {
+        'produto_id': produto['id'],
+        'tipo': item['tipo'],
+        'quantidade': quantidade,
+        'setor': setor,
+        'observacao': item.get('observacao'),
+        'filial_id': produto['filial_id'],
+        'data_movimentacao': data_movimentacao,
+        'custo_unitario': custo_unitario
+    }
+
+
+_VALIDADORES = {
+    'produtos': _validar_produto,
+    'movimentacoes': _validar_movimentacao
+}
+
+
+def _gravador(max_lotes, janela):
+    """Consome a fila agrupando vários lotes em uma única transação"""
+    while True:
+        tarefas = [_fila.get()]
+        # Janela curta para juntar requisições concorrentes no mesmo commit
+        limite = time.monotonic() + janela
+        while len(tarefas) < max_lotes:
+            restante = limite - time.monotonic()
+            try:
+                tarefas.append(_fila.get(timeout=restante) if restante > 0 else _fila.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            resultados = gravar_lotes([(t.tipo, t.itens, t.chave) for t in tarefas])
+        except Exception as e:
+            resultados = [e] * len(tarefas)
+
+        for tarefa, resultado in zip(tarefas, resultados):
+            tarefa.resultado = resultado
+            if tarefa.chave and not isinstance(resultado, Exception):
+                with _respostas_lock:
+                    _respostas_recentes[tarefa.chave] = resultado
+                    while len(_respostas_recentes) > MAX_RESPOSTAS_RECENTES:
+                        _respostas_recentes.popitem(last=False)
+            tarefa.concluida.set()
+
+
+class IngestaoHandler(BaseHTTPRequestHandler):
+    """Atende as requisições de ingestão"""
+
+    protocol_version = "HTTP/1.1"
+
+    def _responder(self, status, corpo, cabecalhos=None):
+        dados = json.dumps(corpo, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(dados)))
+        for nome, valor in (cabecalhos or {}).items():
+            self.send_header(nome, valor)
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def log_message(self, format, *args):
+        if _config.get('verbose'):
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path == "/saude":
+            self._responder(200, {"status": "ok", "fila": _fila.qsize(), "capacidade": _fila.maxsize})
+        else:
+            self._responder(404, {"erro": "Rota não encontrada"})
+
+    def do_POST(self):
+        tipo = self.path.strip("/")
+        if tipo not in _VALIDADORES:
+            self._responder(404, {"erro": "Rota não encontrada"})
+            return
+
+        try:
+            tamanho = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            tamanho = -1
+        if tamanho < 0 or tamanho > MAX_BYTES_REQUISICAO:
+            # O corpo não será lido: a conexão não pode ser reaproveitada
+            self.close_connection = True
+            if tamanho < 0:
+                self._responder(400, {"erro": "Content-Length inválido"})
+            else:
+                self._responder(413, {"erro": "Requisição muito grande"})
+            return
+
+        try:
+            corpo = json.loads(self.rfile.read(tamanho) or b"{}")
+            itens = corpo.get("itens") if isinstance(corpo, dict) else corpo
+            if not isinstance(itens, list) or not itens:
+                raise ErroValidacao("envie uma lista não vazia em 'itens'")
+            if len(itens) > MAX_ITENS_REQUISICAO:
+                raise ErroValidacao(f"máximo de {MAX_ITENS_REQUISICAO} itens por requisição")
+            if not all(isinstance(item, dict) for item in itens):
+                raise ErroValidacao("cada item deve ser um objeto JSON")
+            itens = [_VALIDADORES[tipo](item) for item in itens]
+        except ValueError as e:
+            # ErroValidacao e JSON inválido
+            self._responder(400, {"erro": str(e)})
+            return
+        except Exception as e:
+            # Falha do banco ao atualizar o catálogo usado na validação
+            self._responder(503, {"erro": f"Serviço indisponível: {e}"}, {"Retry-After": "1"})
+            return
+
+        chave = self.headers.get("Idempotency-Key")
+        if chave:
+            chave = f"{tipo}:{chave}"
+            with _respostas_lock:
+                ids = _respostas_recentes.get(chave)
+            if ids is not None:
+                self._responder(201, {"ids": ids})
+                return
+
+        tarefa = Tarefa(tipo, itens, chave)
+        try:
+            _fila.put(tarefa, timeout=_config['espera_fila'])
+        except queue.Full:
+            self._responder(503, {"erro": "Fila cheia, tente novamente"}, {"Retry-After": "1"})
+            return
+
+        if not tarefa.concluida.wait(_config['tempo_limite']):
+            self._responder(504, {"erro": "Tempo limite aguardando gravação"})
+            return
+
+        if isinstance(tarefa.resultado, ERROS_DE_DADOS):
+            self._responder(422, {"erro": str(tarefa.resultado)})
+        elif isinstance(tarefa.resultado, Exception):
+            # Queda de conexão, deadlock, falha no commit: o cliente deve reenviar
+            self._responder(503, {"erro": f"Serviço indisponível: {tarefa.resultado}"}, {"Retry-After": "1"})
+        else:
+            self._responder(201, {"ids": tarefa.resultado})
+
+
+def servir(args):
+    """Inicia o gravador e o servidor HTTP"""
+    global _fila
+
+    init_database()
+    limpar_chaves_idempotencia(args.dias_idempotencia)
+    # O listener mantém o catálogo usado na validação sincronizado com outros processos
+    iniciar_listener()
+
+    _fila = queue.Queue(maxsize=args.fila)
+    _config.update({
+        'espera_fila': args.espera_fila,
+        'tempo_limite': args.tempo_limite,
+        'verbose': args.verbose
+    })
+    threading.Thread(
+        target=_gravador, args=(args.max_lotes, args.janela_ms / 1000),
+        name="gravador-lotes", daemon=True
+    ).start()
+
+    servidor = ThreadingHTTPServer((args.host, args.porta), IngestaoHandler)
+    print(f"API de ingestão em http://{args.host}:{args.porta} (fila: {args.fila} lotes)")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+
+
+def carga(args):
+    """Gera carga local contra a API e resume latências e vazão"""
+    produto_ids = args.produto_id
+
+    def enviar(_):
+        itens = [{
+            'produto_id': produto_ids[i % len(produto_ids)],
+            'filial_id': args.filial,
+            'tipo': 'Entrada',
+            'quantidade': 1,
+            'setor': 'Teste de carga'
+        } for i in range(args.itens)]
+        requisicao = urllib.request.Request(
+            f"{args.url}/movimentacoes",
+            data=json.dumps({"itens": itens}).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Idempotency-Key": str(uuid.uuid4())},
+            method="POST"
+        )
+        inicio = time.perf_counter()
+        try:
+            with urllib.request.urlopen(requisicao, timeout=60) as resposta:
+                status = resposta.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError:
+            status = 0
+        return status, time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concorrencia) as executor:
+        resultados = list(executor.map(enviar, range(args.requisicoes)))
+    duracao = time.perf_counter() - inicio
+
+    latencias = sorted(r[1] * 1000 for r in resultados)
+    por_status = {}
+    for status, _ in resultados:
+        por_status[status] = por_status.get(status, 0) + 1
+    sucesso = por_status.get(201, 0)
+
+    print(f"Requisições: {len(resultados)} em {duracao:.2f}s ({len(resultados) / duracao:.1f} req/s)")
+    print(f"Movimentações gravadas: {sucesso * args.itens} ({sucesso * args.itens / duracao:.1f}/s)")
+    print(f"Latência (ms): p50={percentil(latencias, 50):.1f} p95={percentil(latencias, 95):.1f} "
+          f"p99={percentil(latencias, 99):.1f} máx={latencias[-1]:.1f}")
+    print("Status: " + ", ".join(f"{s or 'erro de conexão'}={n}" for s, n in sorted(por_status.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API HTTP de ingestão do controle de estoque")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    p_servir = subparsers.add_parser("servir", help="Inicia a API")
+    p_servir.add_argument("--host", default="127.0.0.1")
+    p_servir.add_argument("--porta", type=int, default=8600)
+    p_servir.add_argument("--fila", type=int, default=200, help="Lotes aguardando gravação antes de responder 503 (padrão: 200)")
+    p_servir.add_argument("--espera-fila", type=float, default=0.5, help="Segundos aguardando vaga na fila (padrão: 0.5)")
+    p_servir.add_argument("--max-lotes", type=int, default=50, help="Lotes agrupados por commit (padrão: 50)")
+    p_servir.add_argument("--janela-ms", type=float, default=5, help="Espera para agrupar requisições concorrentes (padrão: 5ms)")
+    p_servir.add_argument("--tempo-limite", type=float, default=30, help="Segundos aguardando a gravação (padrão: 30)")
+    p_servir.add_argument("--dias-idempotencia", type=int, default=7, help="Dias de retenção das chaves de idempotência (padrão: 7)")
+    p_servir.add_argument("--verbose", action="store_true", help="Registra cada requisição")
+    p_servir.set_defaults(func=servir)
+
+    p_carga = subparsers.add_parser("carga", help="Gera carga local contra a API")
+    p_carga.add_argument("--url", default="http://127.0.0.1:8600")
+    p_carga.add_argument("--produto-id", action="append", required=True, help="Produto usado nas movimentações (pode repetir)")
+    p_carga.add_argument("--filial", type=int, required=True)
+    p_carga.add_argument("--requisicoes", type=int, default=1000)
+    p_carga.add_argument("--concorrencia", type=int, default=20)
+    p_carga.add_argument("--itens", type=int, default=10, help="Movimentações por requisição (padrão: 10)")
+    p_carga.set_defaults(func=carga)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
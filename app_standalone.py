@@ -3,6 +3,8 @@ import pandas as pd
 from datetime import datetime
 import uuid
 import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Carregar variáveis de ambiente
@@ -15,12 +17,33 @@ st.set_page_config(
     layout="wide"
 )
 
+@st.cache_resource
+def inicializar_banco():
+    """Cria as tabelas e inicia o listener uma única vez por processo (não a cada rerun)"""
+    init_database()
+    # Uma thread por processo escuta os NOTIFY e mantém o cache de leituras atualizado
+    iniciar_listener()
+    # Movimentações sem saldo no razão de custo: a reconstrução é uma tarefa de manutenção
+    return razao_pendente()
+
+@st.cache_resource
+def pool_leituras():
+    """Pool compartilhado pelas sessões para as leituras de cada rerun
+    
+    Dimensionado pela capacidade da engine (pool_size + max_overflow): com mais
+    threads as consultas só esperariam por uma conexão livre.
+    """
+    return ThreadPoolExecutor(max_workers=2 * POOL_CONEXOES, thread_name_prefix="leituras")
+
 # Tentar importar e inicializar banco PostgreSQL
 try:
     from database_standalone import *
-    init_database()
+    pendente_razao = inicializar_banco()
     usando_banco = True
     st.success("Conectado ao banco PostgreSQL - Dados sincronizados entre filiais!")
+    if pendente_razao:
+        st.warning("Estoque e custo médio de produtos antigos incompletos. "
+                   "Execute: python database_standalone.py reconstruir-razao")
 except Exception as e:
     st.warning(f"Usando modo local temporário. Configure DATABASE_URL no arquivo .env")
     usando_banco = False
@@ -37,7 +60,57 @@ if not usando_banco:
         st.session_state.produtos = pd.DataFrame(columns=['id', 'codigo', 'nome', 'valor', 'filial_id', 'data_cadastro'])
     
     if 'movimentacoes' not in st.session_state:
-        st.session_state.movimentacoes = pd.DataFrame(columns=['id', 'produto_id', 'tipo', 'quantidade', 'setor', 'observacao', 'filial_id', 'data_movimentacao'])
+        st.session_state.movimentacoes = pd.DataFrame(columns=['id', 'produto_id', 'tipo', 'quantidade', 'setor', 'observacao', 'filial_id', 'data_movimentacao', 'custo_unitario'])
+
+# Limite de linhas enviadas ao navegador em cada tabela
+LIMITE_LINHAS_TABELA = 5000
+
+def exibir_tabela(df, colunas, moeda=(), datas=(), limite_linhas=LIMITE_LINHAS_TABELA):
+    """Exibe um DataFrame com colunas tipadas e formatação declarativa de R$ e datas"""
+    df_exibir = df[list(colunas)]
+    if len(df_exibir) > limite_linhas:
+        st.caption(f"Exibindo {limite_linhas} de {len(df_exibir)} linhas. Use os filtros para refinar.")
+        df_exibir = df_exibir.head(limite_linhas)
+    
+    # Valores monetários chegam do banco como Decimal: converter mantém a ordenação numérica
+    df_exibir = df_exibir.astype({coluna: 'float64' for coluna in moeda})
+    
+    config = {}
+    for coluna, rotulo in colunas.items():
+        if coluna in moeda:
+            config[coluna] = st.column_config.NumberColumn(rotulo, format="R$ %.2f")
+        elif coluna in datas:
+            config[coluna] = st.column_config.DatetimeColumn(rotulo, format="DD/MM/YYYY HH:mm")
+        else:
+            config[coluna] = st.column_config.Column(rotulo)
+    
+    st.dataframe(df_exibir, column_config=config, hide_index=True, use_container_width=True)
+
+class CarregadorDados:
+    """Dados de um rerun: pedidos idênticos são consultados uma vez e os independentes em paralelo"""
+    
+    def __init__(self, paralelo):
+        # No modo local os dados estão em st.session_state, acessível só na thread do script
+        self.paralelo = paralelo
+        self.pedidos = {}
+        self.nomes = {}
+    
+    def pedir(self, nome, funcao, *args):
+        """Declara um conjunto de dados; com banco a consulta já começa em segundo plano"""
+        chave = (funcao, args)
+        if chave not in self.pedidos:
+            self.pedidos[chave] = pool_leituras().submit(funcao, *args) if self.paralelo else None
+        self.nomes[nome] = chave
+    
+    def obter(self, nome):
+        """Retorna o conjunto de dados, aguardando a consulta se necessário"""
+        chave = self.nomes[nome]
+        if self.paralelo:
+            return self.pedidos[chave].result()
+        if self.pedidos[chave] is None:
+            funcao, args = chave
+            self.pedidos[chave] = (funcao(*args),)
+        return self.pedidos[chave][0]
 
 # Funções adaptadoras que usam banco ou dados locais
 def get_filiais_adaptado():
@@ -82,19 +155,18 @@ def produto_existe_adaptado(codigo, filial_id):
             return False
         return not produtos[(produtos['codigo'] == codigo) & (produtos['filial_id'] == filial_id)].empty
 
-def get_produto_por_codigo_adaptado(codigo, filial_id):
+def get_catalogo_adaptado(filial_id):
     if usando_banco:
-        return get_produto_por_codigo(codigo, filial_id)
+        return get_catalogo(filial_id)
     else:
         produtos = st.session_state.produtos
         if produtos.empty:
-            return None
-        produto = produtos[(produtos['codigo'] == codigo) & (produtos['filial_id'] == filial_id)]
-        return produto.iloc[0].to_dict() if not produto.empty else None
+            return []
+        return produtos[produtos['filial_id'] == filial_id].to_dict('records')
 
-def registrar_movimentacao_adaptado(produto_id, tipo, quantidade, setor, observacao, filial_id, data_movimentacao=None):
+def registrar_movimentacao_adaptado(produto_id, tipo, quantidade, setor, observacao, filial_id, data_movimentacao=None, custo_unitario=None):
     if usando_banco:
-        registrar_movimentacao(produto_id, tipo, quantidade, setor, observacao, filial_id, data_movimentacao)
+        registrar_movimentacao(produto_id, tipo, quantidade, setor, observacao, filial_id, data_movimentacao, custo_unitario)
     else:
         if data_movimentacao is None:
             data_movimentacao = datetime.now()
@@ -107,7 +179,8 @@ def registrar_movimentacao_adaptado(produto_id, tipo, quantidade, setor, observa
             'setor': [setor],
             'observacao': [observacao],
             'filial_id': [filial_id],
-            'data_movimentacao': [data_movimentacao]
+            'data_movimentacao': [data_movimentacao],
+            'custo_unitario': [custo_unitario if tipo == 'Entrada' else None]
         })
         
         if st.session_state.movimentacoes.empty:
@@ -144,7 +217,10 @@ def get_estoque_atual_adaptado(filial_id=None):
                 'nome': produto['nome'],
                 'valor': produto['valor'],
                 'quantidade_atual': quantidade_atual,
-                'filial_id': produto['filial_id']
+                'filial_id': produto['filial_id'],
+                # Modo local não mantém razão de custos: usa o valor cadastrado
+                'custo_medio': produto['valor'],
+                'valor_total': quantidade_atual * produto['valor']
             })
         
         return pd.DataFrame(estoque_list)
@@ -192,8 +268,12 @@ def remover_movimentacoes_adaptado(movimentacao_ids):
 st.title("📦 Pasqualotto Controle de Estoque Multi-Filial")
 st.markdown("---")
 
+# Dados do rerun: só as filiais são comuns a todas as abas
+carregador = CarregadorDados(paralelo=usando_banco)
+carregador.pedir('filiais', get_filiais_adaptado)
+
 # Seleção de filial
-filiais_df = get_filiais_adaptado()
+filiais_df = carregador.obter('filiais')
 if filiais_df.empty:
     st.error("Nenhuma filial encontrada!")
     st.stop()
@@ -214,17 +294,35 @@ with col_info:
         status_conexao = "🌐 ONLINE - PostgreSQL" if usando_banco else "💾 LOCAL"
         st.info(f"🏢 Filial: **{nome_filial}** | {status_conexao}")
 
-# Navegação por abas
-tab1, tab2, tab3, tab4, tab5 = st.tabs([
+# Navegação por abas: só a aba aberta é executada, então cada rerun consulta
+# apenas os dados que ela exibe
+ABAS = [
     "➕ Adicionar Produtos", 
     "📋 Histórico de Produtos", 
     "🔄 Entrada/Saída", 
     "📊 Estoque Atual",
-    "🌐 Visão Geral"
-])
+    "🌐 Visão Geral",
+    "📈 Relatórios",
+    "🧮 Inventário"
+]
+aba_atual = st.radio("Seção", ABAS, horizontal=True, label_visibility="collapsed", key="aba_atual")
+
+if aba_atual == ABAS[1]:
+    carregador.pedir('produtos', get_produtos_adaptado, filial_selecionada)
+elif aba_atual == ABAS[2]:
+    carregador.pedir('catalogo', get_catalogo_adaptado, filial_selecionada)
+    carregador.pedir('movimentacoes', get_movimentacoes_adaptado, filial_selecionada)
+elif aba_atual == ABAS[3]:
+    carregador.pedir('estoque', get_estoque_atual_adaptado, filial_selecionada)
+elif aba_atual == ABAS[4]:
+    carregador.pedir('estoque_geral', get_estoque_atual_adaptado)
+elif aba_atual == ABAS[5] and usando_banco:
+    carregador.pedir('relatorio_valorizacao', get_relatorio_valorizacao)
+    carregador.pedir('relatorio_curva_abc', get_relatorio_curva_abc, filial_selecionada)
+    carregador.pedir('relatorio_baixo_giro', get_relatorio_baixo_giro, filial_selecionada)
 
 # Aba 1: Adicionar Produtos
-with tab1:
+if aba_atual == ABAS[0]:
     st.header("Adicionar Novo Produto")
     
     col1, col2 = st.columns(2)
@@ -252,11 +350,11 @@ with tab1:
                 st.error(f"❌ Erro ao adicionar produto: {e}")
 
 # Aba 2: Histórico de Produtos
-with tab2:
+if aba_atual == ABAS[1]:
     st.header("Histórico de Produtos Cadastrados")
     
     try:
-        produtos_df = get_produtos_adaptado(filial_selecionada)
+        produtos_df = carregador.obter('produtos')
         
         if not produtos_df.empty:
             # Filtros
@@ -310,12 +408,12 @@ with tab2:
                             st.write(f"**{len(produtos_selecionados)}** produto(s) selecionado(s)")
                 else:
                     # Exibição normal
-                    df_exibir = df_filtrado[['codigo', 'nome', 'valor', 'data_cadastro']].copy()
-                    df_exibir['valor'] = df_exibir['valor'].apply(lambda x: f"R$ {x:.2f}")
-                    df_exibir['data_cadastro'] = df_exibir['data_cadastro'].dt.strftime("%d/%m/%Y %H:%M")
-                    df_exibir.columns = ['Código', 'Nome', 'Valor', 'Data de Cadastro']
-                    
-                    st.dataframe(df_exibir, use_container_width=True)
+                    exibir_tabela(
+                        df_filtrado,
+                        {'codigo': 'Código', 'nome': 'Nome', 'valor': 'Valor', 'data_cadastro': 'Data de Cadastro'},
+                        moeda=['valor'],
+                        datas=['data_cadastro']
+                    )
                     st.info(f"📊 Total de produtos: {len(df_filtrado)}")
             else:
                 st.warning("⚠️ Nenhum produto encontrado com os filtros aplicados.")
@@ -325,34 +423,51 @@ with tab2:
         st.error(f"❌ Erro ao carregar produtos: {e}")
 
 # Aba 3: Entrada/Saída
-with tab3:
+if aba_atual == ABAS[2]:
     st.header("Movimentação de Estoque")
     
     try:
-        produtos_df = get_produtos_adaptado(filial_selecionada)
+        catalogo = carregador.obter('catalogo')
+        produtos_por_id = {str(p['id']): p for p in catalogo}
         
-        if not produtos_df.empty:
+        if produtos_por_id:
             col1, col2 = st.columns(2)
             
             with col1:
-                opcoes_produtos = [f"{row['codigo']} - {row['nome']}" for _, row in produtos_df.iterrows()]
-                produto_selecionado = st.selectbox("Selecione o Produto*", opcoes_produtos)
+                produto_selecionado = st.selectbox(
+                    "Selecione o Produto*",
+                    options=list(produtos_por_id),
+                    format_func=lambda x: f"{produtos_por_id[x]['codigo']} - {produtos_por_id[x]['nome']}"
+                )
                 
                 tipo_movimentacao = st.selectbox("Tipo de Movimentação*", ["Entrada", "Saída"])
                 quantidade = st.number_input("Quantidade*", min_value=1, step=1)
                 
+                custo_unitario = None
+                if tipo_movimentacao == "Entrada":
+                    custo_unitario = st.number_input(
+                        "Custo Unitário (R$)",
+                        min_value=0.0,
+                        value=float(produtos_por_id[produto_selecionado]['valor']),
+                        step=0.01,
+                        format="%.2f",
+                        help="Usado no custo médio ponderado do produto"
+                    )
+                
             with col2:
                 usar_data_atual = st.checkbox("Usar data e hora atual", value=True)
                 
-                data_selecionada = datetime.now().date()
-                hora_selecionada = datetime.now().time()
+                # Datas digitadas valem no fuso das sessões do banco, não no do servidor do app
+                agora = agora_local() if usando_banco else datetime.now()
+                data_selecionada = agora.date()
+                hora_selecionada = agora.time()
                 
                 if not usar_data_atual:
                     col_data, col_hora = st.columns(2)
                     with col_data:
-                        data_selecionada = st.date_input("Data da Movimentação", value=datetime.now().date())
+                        data_selecionada = st.date_input("Data da Movimentação", value=agora.date())
                     with col_hora:
-                        hora_selecionada = st.time_input("Hora da Movimentação", value=datetime.now().time())
+                        hora_selecionada = st.time_input("Hora da Movimentação", value=agora.time())
                 
                 setor = st.text_input("Setor de Destino*", placeholder="Ex: Almoxarifado, Produção, Vendas")
                 observacao = st.text_area("Observação (opcional)", placeholder="Adicione uma observação")
@@ -360,12 +475,12 @@ with tab3:
             if st.button("📝 Registrar Movimentação", type="primary"):
                 if produto_selecionado and quantidade > 0 and setor.strip():
                     try:
-                        codigo_selecionado = produto_selecionado.split(" - ")[0]
-                        produto = get_produto_por_codigo_adaptado(codigo_selecionado, filial_selecionada)
+                        produto = produtos_por_id.get(produto_selecionado)
                         
                         if produto:
                             if usar_data_atual:
-                                data_movimentacao = datetime.now()
+                                # O banco registra a data e hora (mesmo relógio da API e das contagens)
+                                data_movimentacao = None
                             else:
                                 data_movimentacao = datetime.combine(data_selecionada, hora_selecionada)
                             
@@ -382,7 +497,7 @@ with tab3:
                             
                             registrar_movimentacao_adaptado(
                                 produto['id'], tipo_movimentacao, quantidade, 
-                                setor, observacao, filial_selecionada, data_movimentacao
+                                setor, observacao, filial_selecionada, data_movimentacao, custo_unitario
                             )
                             st.success(f"✅ {tipo_movimentacao} de {quantidade} unidades registrada para {setor}!")
                             st.rerun()
@@ -398,7 +513,7 @@ with tab3:
             st.subheader("📈 Histórico de Movimentações")
             
             try:
-                movimentacoes_df = get_movimentacoes_adaptado(filial_selecionada)
+                movimentacoes_df = carregador.obter('movimentacoes')
                 
                 if not movimentacoes_df.empty:
                     # Filtros
@@ -449,12 +564,15 @@ with tab3:
                                     st.write(f"**{len(itens_selecionados)}** item(ns) selecionado(s)")
                         else:
                             # Exibição normal
-                            df_mov_exibir = df_mov_filtrado[['codigo', 'produto_nome', 'tipo', 'quantidade', 'setor', 'data_movimentacao', 'observacao']]
-                            df_mov_exibir = df_mov_exibir.copy()
-                            df_mov_exibir['data_movimentacao'] = df_mov_exibir['data_movimentacao'].dt.strftime("%d/%m/%Y %H:%M")
-                            df_mov_exibir.columns = ['Código', 'Produto', 'Tipo', 'Quantidade', 'Setor', 'Data', 'Observação']
-                            
-                            st.dataframe(df_mov_exibir, use_container_width=True)
+                            exibir_tabela(
+                                df_mov_filtrado,
+                                {
+                                    'codigo': 'Código', 'produto_nome': 'Produto', 'tipo': 'Tipo',
+                                    'quantidade': 'Quantidade', 'setor': 'Setor',
+                                    'data_movimentacao': 'Data', 'observacao': 'Observação'
+                                },
+                                datas=['data_movimentacao']
+                            )
                             st.info(f"📊 Total de movimentações: {len(df_mov_filtrado)}")
                     else:
                         st.info("📝 Nenhuma movimentação encontrada com o filtro aplicado.")
@@ -468,11 +586,11 @@ with tab3:
         st.error(f"❌ Erro ao carregar dados: {e}")
 
 # Aba 4: Estoque Atual
-with tab4:
+if aba_atual == ABAS[3]:
     st.header("Estoque Atual")
     
     try:
-        estoque_df = get_estoque_atual_adaptado(filial_selecionada)
+        estoque_df = carregador.obter('estoque')
         
         if not estoque_df.empty:
             # Estatísticas
@@ -513,16 +631,15 @@ with tab4:
                 ]
             
             if not df_estoque_filtrado.empty:
-                # Calcular valor total
-                df_estoque_filtrado['valor_total'] = df_estoque_filtrado['quantidade_atual'] * df_estoque_filtrado['valor']
-                
-                # Preparar para exibição
-                df_exibir = df_estoque_filtrado[['codigo', 'nome', 'quantidade_atual', 'valor', 'valor_total']].copy()
-                df_exibir['valor'] = df_exibir['valor'].apply(lambda x: f"R$ {x:.2f}")
-                df_exibir['valor_total'] = df_exibir['valor_total'].apply(lambda x: f"R$ {x:.2f}")
-                df_exibir.columns = ['Código', 'Produto', 'Quantidade', 'Valor Unitário', 'Valor Total']
-                
-                st.dataframe(df_exibir, use_container_width=True)
+                # Valor total vem do razão de custo médio
+                exibir_tabela(
+                    df_estoque_filtrado,
+                    {
+                        'codigo': 'Código', 'nome': 'Produto', 'quantidade_atual': 'Quantidade',
+                        'valor': 'Valor Unitário', 'custo_medio': 'Custo Médio', 'valor_total': 'Valor Total'
+                    },
+                    moeda=['valor', 'custo_medio', 'valor_total']
+                )
                 
                 valor_total_geral = df_estoque_filtrado['valor_total'].sum()
                 st.success(f"💰 Valor total do estoque: R$ {valor_total_geral:.2f}")
@@ -534,36 +651,36 @@ with tab4:
         st.error(f"❌ Erro ao carregar estoque: {e}")
 
 # Aba 5: Visão Geral
-with tab5:
+if aba_atual == ABAS[4]:
     st.header("Visão Geral - Todas as Filiais")
     
     try:
-        estoque_geral = get_estoque_atual_adaptado()
+        estoque_geral = carregador.obter('estoque_geral')
         
         if not estoque_geral.empty:
             # Adicionar nome da filial
-            filiais_df = get_filiais_adaptado()
             estoque_com_filial = estoque_geral.merge(filiais_df, left_on='filial_id', right_on='id', suffixes=('', '_filial'))
             estoque_com_filial = estoque_com_filial.rename(columns={'nome': 'filial_nome'})
+            estoque_com_filial = estoque_com_filial.astype({'valor': 'float64', 'custo_medio': 'float64', 'valor_total': 'float64'})
             
             st.subheader("📊 Resumo por Filial")
             
             # Estatísticas por filial
-            resumo_filiais = estoque_com_filial.groupby('filial_nome').agg({
-                'produto_id': 'count',
-                'quantidade_atual': 'sum',
-                'valor': 'mean'
-            }).round(2)
-            
-            resumo_filiais['valor_total_estoque'] = estoque_com_filial.groupby('filial_nome').apply(
-                lambda x: (x['quantidade_atual'] * x['valor']).sum()
-            ).round(2)
-            
-            resumo_filiais.columns = ['Produtos', 'Qtd Total', 'Valor Médio', 'Valor Total Estoque']
-            resumo_filiais['Valor Médio'] = resumo_filiais['Valor Médio'].apply(lambda x: f"R$ {x:.2f}")
-            resumo_filiais['Valor Total Estoque'] = resumo_filiais['Valor Total Estoque'].apply(lambda x: f"R$ {x:.2f}")
+            resumo_filiais = estoque_com_filial.groupby('filial_nome', as_index=False).agg(
+                produtos=('produto_id', 'count'),
+                quantidade_total=('quantidade_atual', 'sum'),
+                valor_medio=('valor', 'mean'),
+                valor_total_estoque=('valor_total', 'sum')
+            )
             
-            st.dataframe(resumo_filiais, use_container_width=True)
+            exibir_tabela(
+                resumo_filiais,
+                {
+                    'filial_nome': 'Filial', 'produtos': 'Produtos', 'quantidade_total': 'Qtd Total',
+                    'valor_medio': 'Valor Médio', 'valor_total_estoque': 'Valor Total Estoque'
+                },
+                moeda=['valor_medio', 'valor_total_estoque']
+            )
             
             st.markdown("---")
             st.subheader("📋 Estoque Detalhado - Todas as Filiais")
@@ -580,16 +697,17 @@ with tab5:
                 estoque_exibir = estoque_com_filial
             
             if not estoque_exibir.empty:
-                df_geral = estoque_exibir[['filial_nome', 'codigo', 'nome', 'quantidade_atual', 'valor']].copy()
-                df_geral['valor_total'] = df_geral['quantidade_atual'] * df_geral['valor']
-                df_geral['valor'] = df_geral['valor'].apply(lambda x: f"R$ {x:.2f}")
-                df_geral['valor_total'] = df_geral['valor_total'].apply(lambda x: f"R$ {x:.2f}")
-                df_geral.columns = ['Filial', 'Código', 'Produto', 'Quantidade', 'Valor Unit.', 'Valor Total']
+                exibir_tabela(
+                    estoque_exibir,
+                    {
+                        'filial_nome': 'Filial', 'codigo': 'Código', 'nome': 'Produto',
+                        'quantidade_atual': 'Quantidade', 'valor': 'Valor Unit.', 'custo_medio': 'Custo Médio',
+                        'valor_total': 'Valor Total'
+                    },
+                    moeda=['valor', 'custo_medio', 'valor_total']
+                )
                 
-                st.dataframe(df_geral, use_container_width=True)
-                
-                valor_total_geral = estoque_exibir['quantidade_atual'] * estoque_exibir['valor']
-                st.success(f"💰 Valor total do estoque (filtrado): R$ {valor_total_geral.sum():.2f}")
+                st.success(f"💰 Valor total do estoque (filtrado): R$ {estoque_exibir['valor_total'].sum():.2f}")
             else:
                 st.info("📝 Nenhum produto encontrado.")
         else:
@@ -597,6 +715,157 @@ with tab5:
     except Exception as e:
         st.error(f"❌ Erro ao carregar visão geral: {e}")
 
+# Aba 6: Relatórios (pré-calculados pelo worker_relatorios.py)
+if aba_atual == ABAS[5]:
+    st.header("Relatórios Gerenciais")
+    
+    if not usando_banco:
+        st.info("📝 Relatórios disponíveis apenas com o banco PostgreSQL configurado.")
+    else:
+        try:
+            valorizacao_df = carregador.obter('relatorio_valorizacao')
+            
+            if not valorizacao_df.empty:
+                gerado_em = valorizacao_df['gerado_em'].max()
+                st.caption(f"Atualizado em {gerado_em:%d/%m/%Y %H:%M} pelo worker de relatórios")
+                
+                st.subheader("💰 Valorização do Estoque por Filial")
+                exibir_tabela(
+                    valorizacao_df,
+                    {'filial_nome': 'Filial', 'produtos': 'Produtos', 'quantidade_total': 'Qtd Total', 'valor_total': 'Valor Total'},
+                    moeda=['valor_total']
+                )
+                
+                st.markdown("---")
+                st.subheader("🔤 Curva ABC por Valor de Consumo")
+                curva_df = carregador.obter('relatorio_curva_abc')
+                if not curva_df.empty:
+                    exibir_tabela(
+                        curva_df,
+                        {
+                            'classe': 'Classe', 'codigo': 'Código', 'nome': 'Produto',
+                            'quantidade_consumida': 'Qtd Consumida', 'valor_consumo': 'Valor de Consumo',
+                            'percentual_acumulado': '% Acumulado'
+                        },
+                        moeda=['valor_consumo']
+                    )
+                else:
+                    st.info("📝 Nenhuma saída no período analisado.")
+                
+                st.markdown("---")
+                st.subheader("🐢 Produtos de Baixo Giro")
+                baixo_giro_df = carregador.obter('relatorio_baixo_giro')
+                if not baixo_giro_df.empty:
+                    exibir_tabela(
+                        baixo_giro_df,
+                        {
+                            'codigo': 'Código', 'nome': 'Produto', 'quantidade_atual': 'Quantidade',
+                            'valor_parado': 'Valor Parado', 'ultima_saida': 'Última Saída'
+                        },
+                        moeda=['valor_parado'],
+                        datas=['ultima_saida']
+                    )
+                else:
+                    st.info("📝 Nenhum produto parado nesta filial.")
+            else:
+                st.info("📝 Relatórios ainda não gerados. Execute: python worker_relatorios.py")
+        except Exception as e:
+            st.error(f"❌ Erro ao carregar relatórios: {e}")
+
+# Aba 7: Inventário (contagem física)
+if aba_atual == ABAS[6]:
+    st.header("Contagem de Inventário")
+    
+    if not usando_banco:
+        st.info("📝 Contagem de inventário disponível apenas com o banco PostgreSQL configurado.")
+    else:
+        st.caption("Envie a folha de contagem em CSV com as colunas codigo e quantidade.")
+        
+        arquivo_contagem = st.file_uploader("Folha de contagem (CSV)", type=["csv"])
+        zerar_nao_contados = st.checkbox(
+            "Zerar produtos que não estão na folha",
+            help="Produtos da filial ausentes da contagem recebem saída até zerar o estoque"
+        )
+        
+        if arquivo_contagem is not None:
+            # A prévia só é recalculada a pedido: reruns de outras interações reaproveitam a
+            # guardada enquanto arquivo, filial e opção de zerar forem os mesmos
+            chave_contagem = (
+                hashlib.sha256(arquivo_contagem.getvalue()).hexdigest(),
+                filial_selecionada,
+                zerar_nao_contados
+            )
+            previa = st.session_state.get('previa_contagem')
+            if previa is not None and previa['chave'] != chave_contagem:
+                previa = None
+            
+            if st.button("🔍 Pré-visualizar Ajustes"):
+                try:
+                    contagem_df = pd.read_csv(arquivo_contagem, sep=None, engine="python", dtype={'codigo': str})
+                    contagem_df.columns = [c.strip().lower() for c in contagem_df.columns]
+                    
+                    if not {'codigo', 'quantidade'}.issubset(contagem_df.columns):
+                        st.error("❌ O arquivo precisa das colunas codigo e quantidade!")
+                    else:
+                        contagem_df = contagem_df[['codigo', 'quantidade']].dropna()
+                        previa = {
+                            'chave': chave_contagem,
+                            'contagem': contagem_df,
+                            'diferencas': previsualizar_contagem(filial_selecionada, contagem_df, zerar_nao_contados)
+                        }
+                        st.session_state.previa_contagem = previa
+                except Exception as e:
+                    st.error(f"❌ Erro ao processar contagem: {e}")
+            
+            if previa is None:
+                st.info("📝 Clique em Pré-visualizar para comparar a contagem com o estoque atual.")
+            else:
+                contagem_df = previa['contagem']
+                diferencas_df = previa['diferencas']
+                
+                nao_cadastrados = diferencas_df[diferencas_df['produto_id'].isna()]
+                ajustes_df = diferencas_df[diferencas_df['produto_id'].notna() & (diferencas_df['diferenca'] != 0)]
+                
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("📋 Itens na Contagem", len(diferencas_df))
+                with col2:
+                    st.metric("🔄 Ajustes", len(ajustes_df))
+                with col3:
+                    st.metric("💰 Valor dos Ajustes", f"R$ {ajustes_df['valor_ajuste'].astype('float64').sum():.2f}")
+                
+                if not nao_cadastrados.empty:
+                    st.warning(f"⚠️ {len(nao_cadastrados)} código(s) não cadastrado(s) nesta filial serão ignorados: "
+                               + ", ".join(nao_cadastrados['codigo'].head(20)))
+                
+                if not ajustes_df.empty:
+                    exibir_tabela(
+                        ajustes_df,
+                        {
+                            'codigo': 'Código', 'nome': 'Produto', 'quantidade_sistema': 'Estoque Atual',
+                            'quantidade_contada': 'Contado', 'diferenca': 'Diferença',
+                            'custo_medio': 'Custo Médio', 'valor_ajuste': 'Valor do Ajuste'
+                        },
+                        moeda=['custo_medio', 'valor_ajuste']
+                    )
+                    
+                    setor_inventario = st.text_input("Setor dos ajustes", value="Inventário")
+                    
+                    if st.button("✅ Aplicar Ajustes de Inventário", type="primary"):
+                        try:
+                            # A transação recalcula as diferenças com o estoque do momento
+                            contagem_id = aplicar_contagem(
+                                filial_selecionada, contagem_df, setor_inventario.strip() or "Inventário",
+                                zerar_nao_contados=zerar_nao_contados
+                            )
+                            del st.session_state.previa_contagem
+                            st.success(f"✅ Ajustes lançados na contagem {contagem_id}!")
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"❌ Erro ao aplicar contagem: {e}")
+                else:
+                    st.success("✅ Contagem confere com o estoque atual. Nenhum ajuste necessário.")
+
 # Rodapé
 st.markdown("---")
 st.markdown("**Pasqualotto Controle de Estoque Multi-Filial** - Sistema integrado de gestão")
@@ -625,6 +894,10 @@ with st.expander("🚀 Como usar este sistema independentemente"):
        ```bash
        streamlit run app_standalone.py --server.port 8501
        ```
+       Para a aba de relatórios, mantenha o worker rodando em outro terminal:
+       ```bash
+       python worker_relatorios.py
+       ```
     
     5. **Acesse:** http://localhost:8501
     
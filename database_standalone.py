@@ -1,14 +1,83 @@
 import os
+import json
+import time
+import select
+import threading
+import functools
 import pandas as pd
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from sqlalchemy import create_engine, text
-from datetime import datetime
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from zoneinfo import ZoneInfo
 import uuid
 
 # Configuração do banco de dados
 DATABASE_URL = os.getenv('DATABASE_URL')
 
+# Fuso das sessões do banco e das datas digitadas no app: movimentações com data
+# informada e as registradas com o relógio do banco ficam no mesmo horário local
+FUSO_HORARIO = os.getenv('FUSO_HORARIO', 'America/Cuiaba')
+OPCOES_SESSAO = f"-c timezone={FUSO_HORARIO}"
+
+# Engine única por processo; o pool atende as leituras paralelas das sessões
+POOL_CONEXOES = int(os.getenv('POOL_CONEXOES', '5'))
+_engine = None
+_engine_lock = threading.Lock()
+
+# Estado do gerador de UUIDv7 (contador garante ordem dentro do mesmo milissegundo)
+_uuid7_lock = threading.Lock()
+_uuid7_ultimo_ms = 0
+_uuid7_contador = 0
+
+# Canal usado para avisar outras sessões/processos sobre alterações
+CANAL_NOTIFICACOES = 'estoque_alteracoes'
+
+# O PostgreSQL limita o payload do NOTIFY a 8000 bytes
+LIMITE_PAYLOAD_NOTIFY = 7900
+
+# Cache de leituras por filial, válido apenas enquanto o listener estiver conectado
+_cache_leituras = {}
+_cache_lock = threading.Lock()
+_cache_geracao = 0
+_ouvintes = []
+_listener_thread = None
+_listener_conectado = threading.Event()
+
+# Sem notificações por este tempo, o listener testa a conexão com SELECT 1
+INTERVALO_VERIFICACAO_LISTENER = 15
+KEEPALIVES_LISTENER = {
+    'keepalives': 1,
+    'keepalives_idle': 10,
+    'keepalives_interval': 5,
+    'keepalives_count': 3,
+    # Dados sem confirmação (o SELECT 1) também expiram, não só a conexão ociosa
+    'tcp_user_timeout': 30000
+}
+
+# Índice de produtos em memória, compartilhado por todas as sessões do processo
+_catalogo_por_id = {}
+_catalogo_por_codigo = {}
+_catalogo_por_filial = {}
+# Lista ordenada de cada filial, refeita só depois de uma alteração na filial
+_catalogo_ordenado = {}
+_catalogo_marca = None
+_catalogo_sujo = True
+_catalogo_geracao = 0
+_catalogo_atualizado_em = 0.0
+_catalogo_lock = threading.Lock()
+
+# Sem o listener, alterações de outros processos aparecem no catálogo após este tempo (segundos)
+CATALOGO_TTL = float(os.getenv('CATALOGO_TTL', '5'))
+
+# Folga na marca d'água para não perder cadastros com commit atrasado
+MARGEM_CATALOGO = timedelta(seconds=30)
+
 def get_engine():
-    """Cria conexão com o banco de dados"""
+    """Retorna a engine do processo (criada uma vez, com pool de conexões compartilhado)"""
+    global _engine
+    
     if not DATABASE_URL:
         raise ValueError("DATABASE_URL não configurada")
     
@@ -16,16 +85,187 @@ def get_engine():
     if not DATABASE_URL.startswith(('postgresql://', 'postgres://')):
         raise ValueError("DATABASE_URL deve começar com postgresql:// ou postgres://")
     
-    try:
-        return create_engine(DATABASE_URL)
-    except Exception as e:
-        raise ValueError(f"Erro ao conectar com o banco: {e}")
+    with _engine_lock:
+        if _engine is None:
+            try:
+                _engine = create_engine(
+                    DATABASE_URL,
+                    pool_size=POOL_CONEXOES,
+                    max_overflow=POOL_CONEXOES,
+                    pool_pre_ping=True,
+                    connect_args={"options": OPCOES_SESSAO}
+                )
+            except Exception as e:
+                raise ValueError(f"Erro ao conectar com o banco: {e}")
+        return _engine
+
+def agora_local():
+    """Data e hora atuais no FUSO_HORARIO, no mesmo relógio das sessões do banco"""
+    return datetime.now(ZoneInfo(FUSO_HORARIO)).replace(tzinfo=None)
+
+def gerar_uuid7():
+    """Gera um UUID versão 7: timestamp em ms nos 48 bits iniciais, ordenável pelo tempo de criação"""
+    global _uuid7_ultimo_ms, _uuid7_contador
+    
+    with _uuid7_lock:
+        ms = time.time_ns() // 1_000_000
+        if ms <= _uuid7_ultimo_ms:
+            # Mesmo milissegundo (ou relógio voltou): incrementa o contador de 12 bits
+            _uuid7_contador += 1
+            if _uuid7_contador > 0xFFF:
+                _uuid7_ultimo_ms += 1
+                _uuid7_contador = 0
+            ms = _uuid7_ultimo_ms
+        else:
+            _uuid7_ultimo_ms = ms
+            _uuid7_contador = int.from_bytes(os.urandom(2), 'big') & 0x7FF
+        contador = _uuid7_contador
+    
+    aleatorio = int.from_bytes(os.urandom(8), 'big') & ((1 << 62) - 1)
+    valor = (ms << 80) | (0x7 << 76) | (contador << 64) | (0b10 << 62) | aleatorio
+    return str(uuid.UUID(int=valor))
+
+def _notificar(conn, evento, filial_ids, produto_ids=()):
+    """Emite um evento NOTIFY na transação atual (entregue somente após o commit)"""
+    payload = {
+        'evento': evento,
+        'filial_ids': sorted({int(f) for f in filial_ids if f is not None}),
+        'produto_ids': sorted({str(p) for p in produto_ids if p is not None})
+    }
+    mensagem = json.dumps(payload)
+    if len(mensagem) > LIMITE_PAYLOAD_NOTIFY:
+        # Muitos produtos: a invalidação por filial continua correta
+        payload['produto_ids'] = []
+        mensagem = json.dumps(payload)
+    
+    conn.execute(text("SELECT pg_notify(:canal, :payload)"), {
+        "canal": CANAL_NOTIFICACOES,
+        "payload": mensagem
+    })
+    return payload
+
+def _aplicar_evento(payload):
+    """Invalida as leituras em cache afetadas por um evento e avisa os ouvintes"""
+    global _cache_geracao
+    
+    filial_ids = set(payload.get('filial_ids', []))
+    with _cache_lock:
+        _cache_geracao += 1
+        for chave in list(_cache_leituras):
+            filial_chave = chave[1]
+            # Consultas sem filial (todas as filiais) são sempre afetadas
+            if filial_chave is None or not filial_ids or filial_chave in filial_ids:
+                del _cache_leituras[chave]
+        ouvintes = list(_ouvintes)
+    
+    _atualizar_catalogo_por_evento(payload)
+    
+    for callback in ouvintes:
+        try:
+            callback(payload)
+        except Exception:
+            pass
+
+def _limpar_cache():
+    """Descarta todas as leituras em cache"""
+    _aplicar_evento({'evento': 'reconexao', 'filial_ids': [], 'produto_ids': []})
+
+def _cache_por_filial(func):
+    """Guarda o resultado da leitura por filial enquanto o listener estiver ativo"""
+    @functools.wraps(func)
+    def wrapper(filial_id=None):
+        if not _listener_conectado.is_set():
+            return func(filial_id)
+        
+        chave = (func.__name__, filial_id)
+        with _cache_lock:
+            df = _cache_leituras.get(chave)
+            geracao = _cache_geracao
+        
+        if df is None:
+            df = func(filial_id)
+            with _cache_lock:
+                # Só guarda se nenhuma alteração chegou durante a consulta
+                if geracao == _cache_geracao:
+                    _cache_leituras[chave] = df
+        return df.copy()
+    return wrapper
+
+def registrar_ouvinte(callback):
+    """Registra uma função chamada com o payload de cada alteração recebida"""
+    with _cache_lock:
+        _ouvintes.append(callback)
+
+def _escutar_notificacoes():
+    """Loop do listener: recebe os NOTIFY e invalida o cache, reconectando em caso de falha"""
+    while True:
+        conn = None
+        try:
+            # Keepalives do TCP derrubam a conexão em poucos segundos se o link cair
+            conn = psycopg2.connect(DATABASE_URL, options=OPCOES_SESSAO, **KEEPALIVES_LISTENER)
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CANAL_NOTIFICACOES}")
+            
+            # Eventos podem ter sido perdidos enquanto estávamos desconectados
+            _limpar_cache()
+            _listener_conectado.set()
+            
+            while True:
+                if select.select([conn], [], [], INTERVALO_VERIFICACAO_LISTENER) == ([], [], []):
+                    # Sem notificações: confirma que a conexão não está meio aberta
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")
+                conn.poll()
+                while conn.notifies:
+                    notificacao = conn.notifies.pop(0)
+                    try:
+                        payload = json.loads(notificacao.payload)
+                    except ValueError:
+                        payload = {}
+                    _aplicar_evento(payload)
+        except Exception:
+            _listener_conectado.clear()
+            _limpar_cache()
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                conn.close()
+
+def iniciar_listener():
+    """Inicia (uma única vez por processo) a thread que escuta as alterações"""
+    global _listener_thread
+    
+    if not DATABASE_URL:
+        raise ValueError("DATABASE_URL não configurada")
+    
+    with _cache_lock:
+        if _listener_thread is not None and _listener_thread.is_alive():
+            return
+        _listener_thread = threading.Thread(
+            target=_escutar_notificacoes, name="listener-estoque", daemon=True
+        )
+        _listener_thread.start()
 
 def init_database():
     """Inicializa as tabelas do banco de dados"""
     engine = get_engine()
     
     with engine.connect() as conn:
+        # UUIDv7 no banco: mesmo formato gerado pelo app, usado como padrão das chaves
+        conn.execute(text("""
+            CREATE OR REPLACE FUNCTION uuid_v7(momento TIMESTAMPTZ DEFAULT clock_timestamp())
+            RETURNS UUID AS $$
+                SELECT encode(
+                    set_bit(set_bit(
+                        overlay(uuid_send(gen_random_uuid())
+                                placing substring(int8send(floor(extract(epoch FROM momento) * 1000)::BIGINT) FROM 3)
+                                FROM 1 FOR 6),
+                        52, 1), 53, 1),
+                    'hex')::UUID
+            $$ LANGUAGE sql VOLATILE
+        """))
+        
         # Criar tabela de filiais
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS filiais (
@@ -46,7 +286,7 @@ def init_database():
         # Criar tabela de produtos
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS produtos (
-                id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+                id UUID PRIMARY KEY DEFAULT uuid_v7(),
                 codigo VARCHAR(50) NOT NULL,
                 nome VARCHAR(200) NOT NULL,
                 valor DECIMAL(10,2) NOT NULL,
@@ -59,7 +299,7 @@ def init_database():
         # Criar tabela de movimentações
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS movimentacoes (
-                id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+                id UUID PRIMARY KEY DEFAULT uuid_v7(),
                 produto_id UUID REFERENCES produtos(id) ON DELETE CASCADE,
                 tipo VARCHAR(10) NOT NULL CHECK (tipo IN ('Entrada', 'Saída')),
                 quantidade INTEGER NOT NULL CHECK (quantidade > 0),
@@ -70,6 +310,113 @@ def init_database():
             )
         """))
         
+        # Bancos criados antes do UUIDv7 (registros antigos: migrar_ids_uuid7)
+        tabelas_uuid4 = conn.execute(text("""
+            SELECT table_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND column_name = 'id'
+              AND table_name IN ('produtos', 'movimentacoes')
+              AND column_default NOT LIKE 'uuid_v7(%'
+        """)).fetchall()
+        for (tabela,) in tabelas_uuid4:
+            conn.execute(text(f"ALTER TABLE {tabela} ALTER COLUMN id SET DEFAULT uuid_v7()"))
+        
+        # Custo unitário informado nas entradas (custo médio ponderado)
+        conn.execute(text("""
+            ALTER TABLE movimentacoes ADD COLUMN IF NOT EXISTS custo_unitario DECIMAL(14,4)
+        """))
+        
+        # Saldo do razão após cada movimentação: ponto de partida dos reprocessamentos
+        conn.execute(text("""
+            ALTER TABLE movimentacoes
+            ADD COLUMN IF NOT EXISTS saldo_quantidade BIGINT,
+            ADD COLUMN IF NOT EXISTS saldo_custo_medio DECIMAL(14,4),
+            ADD COLUMN IF NOT EXISTS saldo_valor DECIMAL(16,4)
+        """))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_movimentacoes_produto_data
+            ON movimentacoes (produto_id, data_movimentacao, id)
+        """))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_movimentacoes_sem_saldo
+            ON movimentacoes (produto_id) WHERE saldo_quantidade IS NULL
+        """))
+        
+        # Razão de custo médio por produto, atualizado a cada movimentação
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS custos_produtos (
+                produto_id UUID PRIMARY KEY REFERENCES produtos(id) ON DELETE CASCADE,
+                quantidade BIGINT NOT NULL DEFAULT 0,
+                custo_medio DECIMAL(14,4) NOT NULL DEFAULT 0,
+                valor_total DECIMAL(16,4) NOT NULL DEFAULT 0,
+                ultima_movimentacao TIMESTAMP
+            )
+        """))
+        
+        # Posição (data, id) da última movimentação aplicada: desempata movimentações na mesma data
+        conn.execute(text("""
+            ALTER TABLE custos_produtos ADD COLUMN IF NOT EXISTS ultima_movimentacao_id UUID
+        """))
+        
+        # Contagens físicas de inventário; os ajustes gerados apontam para a contagem
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS contagens_inventario (
+                id UUID PRIMARY KEY DEFAULT uuid_v7(),
+                filial_id INTEGER REFERENCES filiais(id),
+                itens_contados INTEGER NOT NULL,
+                ajustes INTEGER NOT NULL,
+                observacao TEXT,
+                data_contagem TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        
+        conn.execute(text("""
+            ALTER TABLE movimentacoes
+            ADD COLUMN IF NOT EXISTS contagem_id UUID REFERENCES contagens_inventario(id)
+        """))
+        
+        # Chaves de idempotência dos lotes recebidos pela API de ingestão
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS chaves_idempotencia (
+                chave VARCHAR(200) PRIMARY KEY,
+                resposta TEXT NOT NULL,
+                criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        
+        # Tabelas de relatórios, preenchidas pelo worker_relatorios.py
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS relatorio_valorizacao (
+                filial_id INTEGER PRIMARY KEY REFERENCES filiais(id),
+                produtos INTEGER NOT NULL,
+                quantidade_total BIGINT NOT NULL,
+                valor_total DECIMAL(14,2) NOT NULL,
+                gerado_em TIMESTAMP NOT NULL
+            )
+        """))
+        
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS relatorio_curva_abc (
+                produto_id UUID PRIMARY KEY REFERENCES produtos(id) ON DELETE CASCADE,
+                filial_id INTEGER REFERENCES filiais(id),
+                quantidade_consumida BIGINT NOT NULL,
+                valor_consumo DECIMAL(14,2) NOT NULL,
+                percentual_acumulado DECIMAL(6,2) NOT NULL,
+                classe CHAR(1) NOT NULL,
+                gerado_em TIMESTAMP NOT NULL
+            )
+        """))
+        
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS relatorio_baixo_giro (
+                produto_id UUID PRIMARY KEY REFERENCES produtos(id) ON DELETE CASCADE,
+                filial_id INTEGER REFERENCES filiais(id),
+                quantidade_atual BIGINT NOT NULL,
+                valor_parado DECIMAL(14,2) NOT NULL,
+                ultima_saida TIMESTAMP,
+                gerado_em TIMESTAMP NOT NULL
+            )
+        """))
+        
         conn.commit()
 
 def get_filiais():
@@ -79,6 +426,7 @@ def get_filiais():
         result = conn.execute(text("SELECT id, nome FROM filiais ORDER BY id"))
         return pd.DataFrame(result.fetchall(), columns=['id', 'nome'])
 
+@_cache_por_filial
 def get_produtos(filial_id=None):
     """Retorna produtos, opcionalmente filtrados por filial"""
     engine = get_engine()
@@ -88,13 +436,13 @@ def get_produtos(filial_id=None):
                 SELECT id, codigo, nome, valor, filial_id, data_cadastro 
                 FROM produtos 
                 WHERE filial_id = :filial_id 
-                ORDER BY data_cadastro DESC
+                ORDER BY data_cadastro DESC, id DESC
             """), {"filial_id": filial_id})
         else:
             result = conn.execute(text("""
                 SELECT id, codigo, nome, valor, filial_id, data_cadastro 
                 FROM produtos 
-                ORDER BY data_cadastro DESC
+                ORDER BY data_cadastro DESC, id DESC
             """))
         
         df = pd.DataFrame(result.fetchall(), columns=['id', 'codigo', 'nome', 'valor', 'filial_id', 'data_cadastro'])
@@ -102,125 +450,527 @@ def get_produtos(filial_id=None):
             df['data_cadastro'] = pd.to_datetime(df['data_cadastro'])
         return df
 
+COLUNAS_MOVIMENTACOES = [
+    'id', 'produto_id', 'tipo', 'quantidade', 'setor', 
+    'observacao', 'filial_id', 'data_movimentacao', 'codigo', 'produto_nome'
+]
+
+COLUNAS_ESTOQUE = [
+    'produto_id', 'codigo', 'nome', 'valor', 'filial_id', 'quantidade_atual', 'custo_medio', 'valor_total'
+]
+
+def _consulta_movimentacoes(filial_id=None):
+    """Monta a consulta de movimentações, opcionalmente filtrada por filial"""
+    filtro = "WHERE m.filial_id = :filial_id" if filial_id else ""
+    return text(f"""
+        SELECT m.id, m.produto_id, m.tipo, m.quantidade, m.setor, 
+               m.observacao, m.filial_id, m.data_movimentacao,
+               p.codigo, p.nome as produto_nome
+        FROM movimentacoes m
+        JOIN produtos p ON m.produto_id = p.id
+        {filtro}
+        ORDER BY m.data_movimentacao DESC, m.id DESC
+    """), {"filial_id": filial_id}
+
+def _consulta_estoque(filial_id=None):
+    """Monta a consulta de estoque atual, opcionalmente filtrada por filial"""
+    filtro = "WHERE p.filial_id = :filial_id" if filial_id else ""
+    # Quantidade e valorização vêm do razão de custos: leitura simples, sem somar o histórico
+    return text(f"""
+        SELECT 
+            p.id as produto_id,
+            p.codigo,
+            p.nome,
+            p.valor,
+            p.filial_id,
+            COALESCE(c.quantidade, 0) as quantidade_atual,
+            COALESCE(c.custo_medio, p.valor) as custo_medio,
+            COALESCE(c.valor_total, 0) as valor_total
+        FROM produtos p
+        LEFT JOIN custos_produtos c ON c.produto_id = p.id
+        {filtro}
+        ORDER BY p.nome
+    """), {"filial_id": filial_id}
+
+@_cache_por_filial
 def get_movimentacoes(filial_id=None):
     """Retorna movimentações, opcionalmente filtradas por filial"""
     engine = get_engine()
     with engine.connect() as conn:
-        if filial_id:
-            result = conn.execute(text("""
-                SELECT m.id, m.produto_id, m.tipo, m.quantidade, m.setor, 
-                       m.observacao, m.filial_id, m.data_movimentacao,
-                       p.codigo, p.nome as produto_nome
-                FROM movimentacoes m
-                JOIN produtos p ON m.produto_id = p.id
-                WHERE m.filial_id = :filial_id
-                ORDER BY m.data_movimentacao DESC
-            """), {"filial_id": filial_id})
-        else:
-            result = conn.execute(text("""
-                SELECT m.id, m.produto_id, m.tipo, m.quantidade, m.setor, 
-                       m.observacao, m.filial_id, m.data_movimentacao,
-                       p.codigo, p.nome as produto_nome
-                FROM movimentacoes m
-                JOIN produtos p ON m.produto_id = p.id
-                ORDER BY m.data_movimentacao DESC
-            """))
+        result = conn.execute(*_consulta_movimentacoes(filial_id))
         
-        df = pd.DataFrame(result.fetchall(), columns=[
-            'id', 'produto_id', 'tipo', 'quantidade', 'setor', 
-            'observacao', 'filial_id', 'data_movimentacao', 'codigo', 'produto_nome'
-        ])
+        df = pd.DataFrame(result.fetchall(), columns=COLUNAS_MOVIMENTACOES)
         if not df.empty:
             df['data_movimentacao'] = pd.to_datetime(df['data_movimentacao'])
         return df
 
+@_cache_por_filial
 def get_estoque_atual(filial_id=None):
     """Retorna estoque atual, opcionalmente filtrado por filial"""
     engine = get_engine()
     with engine.connect() as conn:
-        if filial_id:
-            result = conn.execute(text("""
-                SELECT 
-                    p.id as produto_id,
-                    p.codigo,
-                    p.nome,
-                    p.valor,
-                    p.filial_id,
-                    COALESCE(
-                        (SELECT SUM(CASE WHEN tipo = 'Entrada' THEN quantidade ELSE -quantidade END)
-                         FROM movimentacoes 
-                         WHERE produto_id = p.id), 0
-                    ) as quantidade_atual
-                FROM produtos p
-                WHERE p.filial_id = :filial_id
-                ORDER BY p.nome
-            """), {"filial_id": filial_id})
-        else:
-            result = conn.execute(text("""
-                SELECT 
-                    p.id as produto_id,
-                    p.codigo,
-                    p.nome,
-                    p.valor,
-                    p.filial_id,
-                    COALESCE(
-                        (SELECT SUM(CASE WHEN tipo = 'Entrada' THEN quantidade ELSE -quantidade END)
-                         FROM movimentacoes 
-                         WHERE produto_id = p.id), 0
-                    ) as quantidade_atual
-                FROM produtos p
-                ORDER BY p.nome
-            """))
+        result = conn.execute(*_consulta_estoque(filial_id))
         
-        return pd.DataFrame(result.fetchall(), columns=[
-            'produto_id', 'codigo', 'nome', 'valor', 'filial_id', 'quantidade_atual'
-        ])
+        return pd.DataFrame(result.fetchall(), columns=COLUNAS_ESTOQUE)
+
+# Orçamento de memória (MB) dos iteradores em blocos; configurável por ambiente
+ORCAMENTO_MEMORIA_MB = float(os.getenv('ORCAMENTO_MEMORIA_MB', '64'))
+
+# Estimativa de bytes por linha (tuplas do cursor + DataFrame tipado)
+BYTES_POR_LINHA_MOVIMENTACAO = 800
+BYTES_POR_LINHA_ESTOQUE = 400
+
+TIPOS_MOVIMENTACOES = {
+    'id': 'string',
+    'produto_id': 'string',
+    'tipo': pd.CategoricalDtype(['Entrada', 'Saída']),
+    'quantidade': 'int64',
+    'setor': 'string',
+    'observacao': 'string',
+    'filial_id': 'Int64',
+    'data_movimentacao': 'datetime64[ns]',
+    'codigo': 'string',
+    'produto_nome': 'string'
+}
+
+TIPOS_ESTOQUE = {
+    'produto_id': 'string',
+    'codigo': 'string',
+    'nome': 'string',
+    'valor': 'float64',
+    'filial_id': 'Int64',
+    'quantidade_atual': 'int64',
+    'custo_medio': 'float64',
+    'valor_total': 'float64'
+}
+
+def tamanho_bloco(bytes_por_linha, orcamento_memoria_mb=None):
+    """Calcula quantas linhas cabem em um bloco dentro do orçamento de memória"""
+    orcamento = orcamento_memoria_mb if orcamento_memoria_mb is not None else ORCAMENTO_MEMORIA_MB
+    # Metade para o buffer do cursor, metade para o DataFrame entregue
+    return max(100, int(orcamento * 1024 * 1024 / 2 / bytes_por_linha))
+
+def _iterar_blocos(consulta, params, colunas, tipos, tamanho):
+    """Executa a consulta em cursor no servidor e entrega DataFrames tipados"""
+    engine = get_engine()
+    with engine.connect() as conn:
+        result = conn.execution_options(
+            stream_results=True, max_row_buffer=tamanho
+        ).execute(consulta, params)
+        
+        for linhas in result.partitions(tamanho):
+            df = pd.DataFrame(linhas, columns=colunas)
+            for coluna in ('id', 'produto_id'):
+                if coluna in df:
+                    df[coluna] = df[coluna].astype(str)
+            yield df.astype(tipos)
+
+def iter_movimentacoes(filial_id=None, orcamento_memoria_mb=None):
+    """Itera as movimentações em blocos de DataFrame, com memória limitada"""
+    consulta, params = _consulta_movimentacoes(filial_id)
+    tamanho = tamanho_bloco(BYTES_POR_LINHA_MOVIMENTACAO, orcamento_memoria_mb)
+    yield from _iterar_blocos(consulta, params, COLUNAS_MOVIMENTACOES, TIPOS_MOVIMENTACOES, tamanho)
+
+def iter_estoque_atual(filial_id=None, orcamento_memoria_mb=None):
+    """Itera o estoque atual em blocos de DataFrame, com memória limitada"""
+    consulta, params = _consulta_estoque(filial_id)
+    tamanho = tamanho_bloco(BYTES_POR_LINHA_ESTOQUE, orcamento_memoria_mb)
+    yield from _iterar_blocos(consulta, params, COLUNAS_ESTOQUE, TIPOS_ESTOQUE, tamanho)
+
+def _razao_vazio(custo_inicial=0):
+    """Estado inicial do razão de custo de um produto (custo inicial: valor do produto)"""
+    return {
+        'quantidade': 0,
+        'custo_medio': Decimal(custo_inicial),
+        'valor_total': Decimal(0),
+        'ultima_movimentacao': None,
+        'ultima_movimentacao_id': None
+    }
+
+def _anterior_ao_razao(razao, data_movimentacao, movimentacao_id):
+    """Indica se a movimentação fica antes da última aplicada ao razão na ordem
+    (data, id) usada nos reprocessamentos"""
+    if razao['ultima_movimentacao'] is None:
+        return False
+    if razao['ultima_movimentacao_id'] is None:
+        # Razão sem o id da última movimentação: empate de data conta como retroativo
+        return data_movimentacao <= razao['ultima_movimentacao']
+    return (data_movimentacao, str(movimentacao_id)) < (razao['ultima_movimentacao'], str(razao['ultima_movimentacao_id']))
+
+def _aplicar_no_razao(razao, tipo, quantidade, custo_unitario, data_movimentacao, movimentacao_id=None):
+    """Aplica uma movimentação ao razão de custo médio ponderado (O(1))"""
+    if tipo == 'Entrada':
+        custo_unitario = Decimal(custo_unitario or 0)
+        quantidade_nova = razao['quantidade'] + quantidade
+        if razao['quantidade'] <= 0:
+            # Sem saldo anterior (ou saldo negativo): o custo da entrada passa a ser o custo médio
+            razao['custo_medio'] = custo_unitario
+        else:
+            razao['custo_medio'] = (razao['valor_total'] + quantidade * custo_unitario) / quantidade_nova
+    else:
+        # Saídas baixam o estoque pelo custo médio, que não se altera
+        quantidade_nova = razao['quantidade'] - quantidade
+    
+    # Mesma regra para entradas e saídas: saldo zerado ou negativo não tem valor
+    razao['valor_total'] = quantidade_nova * razao['custo_medio'] if quantidade_nova > 0 else Decimal(0)
+    razao['quantidade'] = quantidade_nova
+    if not _anterior_ao_razao(razao, data_movimentacao, movimentacao_id):
+        razao['ultima_movimentacao'] = data_movimentacao
+        razao['ultima_movimentacao_id'] = movimentacao_id
+
+def _gravar_razoes(conn, razoes):
+    """Grava o estado de vários razões de custo com um único UPDATE"""
+    if not razoes:
+        return
+    ids = list(razoes)
+    conn.execute(text("""
+        UPDATE custos_produtos c
+        SET quantidade = r.quantidade,
+            custo_medio = r.custo_medio,
+            valor_total = r.valor_total,
+            ultima_movimentacao = r.ultima_movimentacao,
+            ultima_movimentacao_id = r.ultima_movimentacao_id
+        FROM unnest(
+            CAST(:produto_ids AS UUID[]),
+            CAST(:quantidades AS BIGINT[]),
+            CAST(:custos AS DECIMAL[]),
+            CAST(:valores AS DECIMAL[]),
+            CAST(:datas AS TIMESTAMP[]),
+            CAST(:movimentacao_ids AS UUID[])
+        ) AS r(produto_id, quantidade, custo_medio, valor_total, ultima_movimentacao, ultima_movimentacao_id)
+        WHERE c.produto_id = r.produto_id
+    """), {
+        "produto_ids": ids,
+        "quantidades": [razoes[i]['quantidade'] for i in ids],
+        "custos": [razoes[i]['custo_medio'] for i in ids],
+        "valores": [razoes[i]['valor_total'] for i in ids],
+        "datas": [razoes[i]['ultima_movimentacao'] for i in ids],
+        "movimentacao_ids": [
+            str(razoes[i]['ultima_movimentacao_id']) if razoes[i]['ultima_movimentacao_id'] else None
+            for i in ids
+        ]
+    })
+
+def _bloquear_razoes(conn, produto_ids):
+    """Bloqueia e retorna os razões de custo dos produtos (ordem fixa evita deadlocks)"""
+    result = conn.execute(text("""
+        SELECT produto_id, quantidade, custo_medio, valor_total, ultima_movimentacao, ultima_movimentacao_id
+        FROM custos_produtos
+        WHERE produto_id = ANY(CAST(:produto_ids AS UUID[]))
+        ORDER BY produto_id
+        FOR UPDATE
+    """), {"produto_ids": sorted(produto_ids)})
+    return {
+        str(r[0]): {
+            'quantidade': r[1],
+            'custo_medio': Decimal(r[2]),
+            'valor_total': Decimal(r[3]),
+            'ultima_movimentacao': r[4],
+            'ultima_movimentacao_id': r[5]
+        }
+        for r in result.fetchall()
+    }
+
+def _gravar_saldos(conn, saldos):
+    """Grava o saldo do razão após cada movimentação com um único UPDATE"""
+    if not saldos:
+        return
+    conn.execute(text("""
+        UPDATE movimentacoes m
+        SET saldo_quantidade = s.quantidade,
+            saldo_custo_medio = s.custo_medio,
+            saldo_valor = s.valor_total
+        FROM unnest(
+            CAST(:ids AS UUID[]),
+            CAST(:quantidades AS BIGINT[]),
+            CAST(:custos AS DECIMAL[]),
+            CAST(:valores AS DECIMAL[])
+        ) AS s(id, quantidade, custo_medio, valor_total)
+        WHERE m.id = s.id
+    """), {
+        "ids": [str(s[0]) for s in saldos],
+        "quantidades": [s[1] for s in saldos],
+        "custos": [s[2] for s in saldos],
+        "valores": [s[3] for s in saldos]
+    })
+
+def _recalcular_custos(conn, inicios):
+    """Reconstrói o razão de custo dos produtos a partir de um ponto do histórico
+    
+    inicios: {produto_id: data}. Só as movimentações a partir da data são
+    reprocessadas, partindo do saldo gravado na última movimentação anterior;
+    data None reconstrói o histórico inteiro do produto.
+    """
+    inicios = {str(p): d for p, d in inicios.items()}
+    if not inicios:
+        return
+    ids = sorted(inicios)
+    _bloquear_razoes(conn, ids)
+    
+    # Sem movimentação anterior o razão parte do valor do produto, como no cadastro
+    valores = conn.execute(text("""
+        SELECT id, valor FROM produtos WHERE id = ANY(CAST(:produto_ids AS UUID[]))
+    """), {"produto_ids": ids}).fetchall()
+    razoes = {produto_id: _razao_vazio() for produto_id in ids}
+    for produto_id, valor in valores:
+        razoes[str(produto_id)] = _razao_vazio(valor)
+    parciais = [p for p in ids if inicios[p] is not None]
+    if parciais:
+        result = conn.execute(text("""
+            SELECT i.produto_id, a.saldo_quantidade, a.saldo_custo_medio, a.saldo_valor, a.data_movimentacao, a.id
+            FROM unnest(CAST(:produto_ids AS UUID[]), CAST(:inicios AS TIMESTAMP[])) AS i(produto_id, inicio)
+            CROSS JOIN LATERAL (
+                SELECT m.saldo_quantidade, m.saldo_custo_medio, m.saldo_valor, m.data_movimentacao, m.id
+                FROM movimentacoes m
+                WHERE m.produto_id = i.produto_id AND m.data_movimentacao < i.inicio
+                ORDER BY m.data_movimentacao DESC, m.id DESC
+                LIMIT 1
+            ) a
+        """), {"produto_ids": parciais, "inicios": [inicios[p] for p in parciais]})
+        for produto_id, quantidade, custo_medio, valor_total, data_movimentacao, mov_id in result:
+            if quantidade is None:
+                # Saldo ainda não gravado: só o histórico completo é confiável
+                inicios[str(produto_id)] = None
+                continue
+            razoes[str(produto_id)] = {
+                'quantidade': quantidade,
+                'custo_medio': Decimal(custo_medio),
+                'valor_total': Decimal(valor_total),
+                'ultima_movimentacao': data_movimentacao,
+                'ultima_movimentacao_id': mov_id
+            }
+    
+    # Cursor no servidor: o histórico é lido e os saldos gravados em blocos de memória limitada
+    tamanho = tamanho_bloco(BYTES_POR_LINHA_MOVIMENTACAO)
+    result = conn.execute(text("""
+        SELECT m.id, m.produto_id, m.tipo, m.quantidade,
+               COALESCE(m.custo_unitario, p.valor), m.data_movimentacao
+        FROM unnest(CAST(:produto_ids AS UUID[]), CAST(:inicios AS TIMESTAMP[])) AS i(produto_id, inicio)
+        JOIN movimentacoes m ON m.produto_id = i.produto_id
+                            AND (i.inicio IS NULL OR m.data_movimentacao >= i.inicio)
+        JOIN produtos p ON p.id = m.produto_id
+        ORDER BY m.data_movimentacao, m.id
+    """), {"produto_ids": ids, "inicios": [inicios[p] for p in ids]},
+        execution_options={"stream_results": True, "max_row_buffer": tamanho})
+    for linhas in result.partitions(tamanho):
+        saldos = []
+        for mov_id, produto_id, tipo, quantidade, custo_unitario, data_movimentacao in linhas:
+            razao = razoes[str(produto_id)]
+            _aplicar_no_razao(razao, tipo, quantidade, custo_unitario, data_movimentacao, mov_id)
+            saldos.append((mov_id, razao['quantidade'], razao['custo_medio'], razao['valor_total']))
+        _gravar_saldos(conn, saldos)
+    
+    _gravar_razoes(conn, razoes)
+
+def _agora_banco(conn):
+    """Data e hora atuais do banco (relógio único para as movimentações sem data informada)"""
+    return conn.execute(text("SELECT clock_timestamp()::TIMESTAMP")).scalar()
+
+def _garantir_razao(conn, produto_ids):
+    """Cria o razão de custo dos produtos que ainda não têm um, reconstruindo o histórico"""
+    result = conn.execute(text("""
+        INSERT INTO custos_produtos (produto_id, custo_medio)
+        SELECT id, valor FROM produtos
+        WHERE id = ANY(CAST(:produto_ids AS UUID[]))
+        ON CONFLICT (produto_id) DO NOTHING
+        RETURNING produto_id
+    """), {"produto_ids": sorted({str(p) for p in produto_ids})})
+    criados = [r[0] for r in result.fetchall()]
+    if criados:
+        _recalcular_custos(conn, {produto_id: None for produto_id in criados})
 
 def adicionar_produto(codigo, nome, valor, filial_id):
     """Adiciona um novo produto"""
     engine = get_engine()
     with engine.connect() as conn:
-        conn.execute(text("""
-            INSERT INTO produtos (codigo, nome, valor, filial_id)
-            VALUES (:codigo, :nome, :valor, :filial_id)
+        result = conn.execute(text("""
+            INSERT INTO produtos (id, codigo, nome, valor, filial_id)
+            VALUES (:id, :codigo, :nome, :valor, :filial_id)
+            RETURNING id
         """), {
+            "id": gerar_uuid7(),
             "codigo": codigo,
             "nome": nome,
             "valor": valor,
             "filial_id": filial_id
         })
+        produto_id = result.scalar()
+        conn.execute(text("""
+            INSERT INTO custos_produtos (produto_id, custo_medio)
+            VALUES (:produto_id, :valor)
+        """), {"produto_id": produto_id, "valor": valor})
+        evento = _notificar(conn, 'produto_adicionado', [filial_id], [produto_id])
         conn.commit()
+    _aplicar_evento(evento)
 
-def registrar_movimentacao(produto_id, tipo, quantidade, setor, observacao, filial_id, data_movimentacao=None):
-    """Registra uma movimentação"""
+def registrar_movimentacao(produto_id, tipo, quantidade, setor, observacao, filial_id, data_movimentacao=None, custo_unitario=None):
+    """Registra uma movimentação (custo_unitario vale para entradas; padrão: valor do produto)"""
     engine = get_engine()
     with engine.connect() as conn:
-        if data_movimentacao:
-            conn.execute(text("""
-                INSERT INTO movimentacoes (produto_id, tipo, quantidade, setor, observacao, filial_id, data_movimentacao)
-                VALUES (:produto_id, :tipo, :quantidade, :setor, :observacao, :filial_id, :data_movimentacao)
-            """), {
-                "produto_id": produto_id,
-                "tipo": tipo,
-                "quantidade": quantidade,
-                "setor": setor,
-                "observacao": observacao,
-                "filial_id": filial_id,
-                "data_movimentacao": data_movimentacao
-            })
+        _, evento = _inserir_movimentacoes(conn, [{
+            "produto_id": produto_id,
+            "tipo": tipo,
+            "quantidade": quantidade,
+            "setor": setor,
+            "observacao": observacao,
+            "filial_id": filial_id,
+            "data_movimentacao": data_movimentacao,
+            "custo_unitario": custo_unitario
+        }])
+        conn.commit()
+    _aplicar_evento(evento)
+
+def _inserir_produtos(conn, produtos):
+    """Insere vários produtos com um único INSERT (sem commit)"""
+    result = conn.execute(text("""
+        INSERT INTO produtos (id, codigo, nome, valor, filial_id)
+        SELECT * FROM unnest(
+            CAST(:ids AS UUID[]),
+            CAST(:codigos AS VARCHAR[]),
+            CAST(:nomes AS VARCHAR[]),
+            CAST(:valores AS DECIMAL[]),
+            CAST(:filial_ids AS INTEGER[])
+        )
+        RETURNING id, filial_id, valor
+    """), {
+        "ids": [p.get('id') or gerar_uuid7() for p in produtos],
+        "codigos": [p['codigo'] for p in produtos],
+        "nomes": [p['nome'] for p in produtos],
+        "valores": [p['valor'] for p in produtos],
+        "filial_ids": [p['filial_id'] for p in produtos]
+    })
+    inseridos = result.fetchall()
+    conn.execute(text("""
+        INSERT INTO custos_produtos (produto_id, custo_medio)
+        SELECT * FROM unnest(CAST(:produto_ids AS UUID[]), CAST(:valores AS DECIMAL[]))
+    """), {
+        "produto_ids": [str(r[0]) for r in inseridos],
+        "valores": [r[2] for r in inseridos]
+    })
+    evento = _notificar(conn, 'produto_adicionado', [r[1] for r in inseridos], [r[0] for r in inseridos])
+    return [str(r[0]) for r in inseridos], evento
+
+def _inserir_movimentacoes(conn, movimentacoes):
+    """Insere várias movimentações com um único INSERT e atualiza o razão de custos (sem commit)"""
+    produto_ids = {str(m['produto_id']) for m in movimentacoes}
+    _garantir_razao(conn, produto_ids)
+    razoes = _bloquear_razoes(conn, produto_ids)
+    # Sem data informada vale o relógio do banco, lido depois da trava dos razões: a
+    # ordem das movimentações não depende do fuso nem do relógio de cada cliente
+    agora = _agora_banco(conn)
+    
+    result = conn.execute(text("""
+        INSERT INTO movimentacoes (id, produto_id, tipo, quantidade, setor, observacao, filial_id,
+                                   data_movimentacao, custo_unitario)
+        SELECT m.id, m.produto_id, m.tipo, m.quantidade, m.setor, m.observacao, m.filial_id,
+               COALESCE(m.data_movimentacao, :agora),
+               CASE WHEN m.tipo = 'Entrada' THEN COALESCE(m.custo_unitario, p.valor) END
+        FROM unnest(
+            CAST(:ids AS UUID[]),
+            CAST(:produto_ids AS UUID[]),
+            CAST(:tipos AS VARCHAR[]),
+            CAST(:quantidades AS INTEGER[]),
+            CAST(:setores AS VARCHAR[]),
+            CAST(:observacoes AS TEXT[]),
+            CAST(:filial_ids AS INTEGER[]),
+            CAST(:datas AS TIMESTAMP[]),
+            CAST(:custos AS DECIMAL[])
+        ) WITH ORDINALITY AS m(id, produto_id, tipo, quantidade, setor, observacao, filial_id,
+                               data_movimentacao, custo_unitario, ordem)
+        LEFT JOIN produtos p ON p.id = m.produto_id
+        ORDER BY m.ordem
+        RETURNING id, produto_id, filial_id, tipo, quantidade, custo_unitario, data_movimentacao
+    """), {
+        "ids": [m.get('id') or gerar_uuid7() for m in movimentacoes],
+        "produto_ids": [str(m['produto_id']) for m in movimentacoes],
+        "tipos": [m['tipo'] for m in movimentacoes],
+        "quantidades": [m['quantidade'] for m in movimentacoes],
+        "setores": [m['setor'] for m in movimentacoes],
+        "observacoes": [m.get('observacao') for m in movimentacoes],
+        "filial_ids": [m['filial_id'] for m in movimentacoes],
+        "datas": [m.get('data_movimentacao') for m in movimentacoes],
+        "custos": [m.get('custo_unitario') for m in movimentacoes],
+        "agora": agora
+    })
+    inseridas = result.fetchall()
+    
+    # Atualização O(1) por movimentação; datas retroativas reprocessam o produto só a partir delas
+    retroativos = {}
+    saldos = []
+    for mov_id, produto_id, _, tipo, quantidade, custo_unitario, data_movimentacao in sorted(
+            inseridas, key=lambda r: (r[6], str(r[0]))):
+        produto_id = str(produto_id)
+        razao = razoes[produto_id]
+        if produto_id in retroativos:
+            continue
+        if _anterior_ao_razao(razao, data_movimentacao, mov_id):
+            # Em ordem de data, a primeira retroativa do produto é o ponto de partida
+            retroativos[produto_id] = data_movimentacao
         else:
-            conn.execute(text("""
-                INSERT INTO movimentacoes (produto_id, tipo, quantidade, setor, observacao, filial_id)
-                VALUES (:produto_id, :tipo, :quantidade, :setor, :observacao, :filial_id)
-            """), {
-                "produto_id": produto_id,
-                "tipo": tipo,
-                "quantidade": quantidade,
-                "setor": setor,
-                "observacao": observacao,
-                "filial_id": filial_id
-            })
+            _aplicar_no_razao(razao, tipo, quantidade, custo_unitario, data_movimentacao, mov_id)
+            saldos.append((mov_id, razao['quantidade'], razao['custo_medio'], razao['valor_total']))
+    
+    _gravar_saldos(conn, saldos)
+    _gravar_razoes(conn, {k: v for k, v in razoes.items() if k not in retroativos})
+    if retroativos:
+        _recalcular_custos(conn, retroativos)
+    evento = _notificar(conn, 'movimentacao_registrada', [r[2] for r in inseridas], [r[1] for r in inseridas])
+    return [str(r[0]) for r in inseridas], evento
+
+_GRAVADORES_LOTE = {
+    'produtos': _inserir_produtos,
+    'movimentacoes': _inserir_movimentacoes
+}
+
+def gravar_lotes(lotes):
+    """Grava vários lotes em uma única transação (commit agrupado)
+    
+    Cada lote é uma tupla (tipo, itens, chave_idempotencia), com tipo 'produtos' ou
+    'movimentacoes'. Falhas ficam isoladas por savepoint: retorna, para cada lote,
+    a lista de ids inseridos ou a exceção que o impediu.
+    """
+    resultados = []
+    eventos = []
+    engine = get_engine()
+    with engine.connect() as conn:
+        for tipo, itens, chave in lotes:
+            try:
+                with conn.begin_nested():
+                    if chave:
+                        resposta = conn.execute(text("""
+                            SELECT resposta FROM chaves_idempotencia WHERE chave = :chave
+                        """), {"chave": chave}).scalar()
+                        if resposta is not None:
+                            # Lote repetido: devolve os ids da primeira gravação
+                            resultados.append(json.loads(resposta))
+                            continue
+                    
+                    ids, evento = _GRAVADORES_LOTE[tipo](conn, itens)
+                    
+                    if chave:
+                        conn.execute(text("""
+                            INSERT INTO chaves_idempotencia (chave, resposta)
+                            VALUES (:chave, :resposta)
+                        """), {"chave": chave, "resposta": json.dumps(ids)})
+                resultados.append(ids)
+                eventos.append(evento)
+            except Exception as e:
+                resultados.append(e)
         conn.commit()
+    
+    for evento in eventos:
+        _aplicar_evento(evento)
+    return resultados
+
+def limpar_chaves_idempotencia(dias=7):
+    """Remove chaves de idempotência mais antigas que o prazo informado"""
+    engine = get_engine()
+    with engine.connect() as conn:
+        result = conn.execute(text("""
+            DELETE FROM chaves_idempotencia WHERE criado_em < :limite
+        """), {"limite": agora_local() - timedelta(days=dias)})
+        conn.commit()
+        return result.rowcount
 
 def produto_existe(codigo, filial_id):
     """Verifica se um produto já existe"""
@@ -232,27 +982,139 @@ def produto_existe(codigo, filial_id):
         """), {"codigo": codigo, "filial_id": filial_id})
         return result.scalar() > 0
 
-def get_produto_por_codigo(codigo, filial_id):
-    """Retorna produto pelo código"""
+def _produto_de_linha(row):
+    """Converte uma linha de produtos no dicionário usado pelo catálogo"""
+    return {
+        'id': str(row[0]),
+        'codigo': row[1],
+        'nome': row[2],
+        'valor': float(row[3]),
+        'filial_id': row[4],
+        'data_cadastro': row[5]
+    }
+
+def _atualizar_catalogo_por_evento(payload):
+    """Marca o catálogo para atualização conforme o evento recebido"""
+    global _catalogo_sujo, _catalogo_marca, _catalogo_geracao
+    
+    evento = payload.get('evento')
+    produto_ids = payload.get('produto_ids', [])
+    with _catalogo_lock:
+        if evento == 'produto_adicionado':
+            _catalogo_sujo = True
+        elif evento == 'produtos_removidos' and produto_ids:
+            _catalogo_geracao += 1
+            for produto_id in produto_ids:
+                produto = _catalogo_por_id.pop(str(produto_id), None)
+                if produto:
+                    _catalogo_por_codigo.pop((produto['filial_id'], produto['codigo']), None)
+                    _catalogo_por_filial.get(produto['filial_id'], {}).pop(produto['id'], None)
+                    _catalogo_ordenado.pop(produto['filial_id'], None)
+        elif evento in ('produtos_removidos', 'reconexao', 'ids_migrados'):
+            # Sem a lista de ids (ou com eventos perdidos) só uma recarga completa é segura
+            _catalogo_geracao += 1
+            _catalogo_marca = None
+            _catalogo_sujo = True
+
+def atualizar_catalogo():
+    """Atualiza o índice de produtos a partir da marca d'água de data_cadastro"""
+    global _catalogo_por_id, _catalogo_por_codigo, _catalogo_por_filial, _catalogo_ordenado
+    global _catalogo_marca, _catalogo_sujo, _catalogo_atualizado_em
+    
+    with _catalogo_lock:
+        marca = _catalogo_marca
+        geracao = _catalogo_geracao
+        _catalogo_sujo = False
+        _catalogo_atualizado_em = time.monotonic()
+    
     engine = get_engine()
     with engine.connect() as conn:
-        result = conn.execute(text("""
-            SELECT id, codigo, nome, valor, filial_id, data_cadastro 
-            FROM produtos 
-            WHERE codigo = :codigo AND filial_id = :filial_id
-        """), {"codigo": codigo, "filial_id": filial_id})
+        if marca is not None and not _listener_conectado.is_set():
+            # Sem notificações, remoções de outros processos só aparecem na contagem
+            total = conn.execute(text("SELECT COUNT(*) FROM produtos")).scalar()
+        else:
+            total = None
         
-        row = result.fetchone()
-        if row:
-            return {
-                'id': str(row[0]),
-                'codigo': row[1],
-                'nome': row[2],
-                'valor': float(row[3]),
-                'filial_id': row[4],
-                'data_cadastro': row[5]
-            }
-        return None
+        if marca is None:
+            result = conn.execute(text("""
+                SELECT id, codigo, nome, valor, filial_id, data_cadastro 
+                FROM produtos
+            """))
+        else:
+            result = conn.execute(text("""
+                SELECT id, codigo, nome, valor, filial_id, data_cadastro 
+                FROM produtos 
+                WHERE data_cadastro >= :marca
+            """), {"marca": marca - MARGEM_CATALOGO})
+        produtos = [_produto_de_linha(row) for row in result.fetchall()]
+    
+    with _catalogo_lock:
+        if geracao != _catalogo_geracao:
+            # Uma remoção chegou durante a consulta: recarregar na próxima leitura
+            _catalogo_sujo = True
+            return
+        
+        if marca is None:
+            _catalogo_por_id = {}
+            _catalogo_por_codigo = {}
+            _catalogo_por_filial = {}
+            _catalogo_ordenado = {}
+        
+        for produto in produtos:
+            _catalogo_por_id[produto['id']] = produto
+            _catalogo_por_codigo[(produto['filial_id'], produto['codigo'])] = produto
+            _catalogo_por_filial.setdefault(produto['filial_id'], {})[produto['id']] = produto
+            _catalogo_ordenado.pop(produto['filial_id'], None)
+            if produto['data_cadastro'] and (_catalogo_marca is None or produto['data_cadastro'] > _catalogo_marca):
+                _catalogo_marca = produto['data_cadastro']
+        
+        if total is not None and total != len(_catalogo_por_id):
+            _catalogo_marca = None
+            _catalogo_sujo = True
+        elif _catalogo_marca is None:
+            # Tabela vazia: próximas leituras continuam incrementais
+            _catalogo_marca = datetime.min + MARGEM_CATALOGO
+
+def _garantir_catalogo():
+    """Atualiza o catálogo apenas quando necessário"""
+    # Com o listener ativo o catálogo só é consultado após uma alteração;
+    # sem ele, no máximo uma atualização a cada CATALOGO_TTL segundos
+    expirado = (
+        not _listener_conectado.is_set()
+        and time.monotonic() - _catalogo_atualizado_em >= CATALOGO_TTL
+    )
+    if _catalogo_sujo or _catalogo_marca is None or expirado:
+        atualizar_catalogo()
+        if _catalogo_marca is None:
+            atualizar_catalogo()
+
+def get_catalogo(filial_id):
+    """Retorna os produtos da filial a partir do índice em memória"""
+    _garantir_catalogo()
+    with _catalogo_lock:
+        ordenados = _catalogo_ordenado.get(filial_id)
+        if ordenados is None:
+            ordenados = sorted(
+                _catalogo_por_filial.get(filial_id, {}).values(),
+                key=lambda p: (p['data_cadastro'] or datetime.min, p['id']),
+                reverse=True
+            )
+            _catalogo_ordenado[filial_id] = ordenados
+        return [dict(p) for p in ordenados]
+
+def get_produto_por_id(produto_id):
+    """Retorna produto pelo id (consulta ao índice em memória)"""
+    _garantir_catalogo()
+    with _catalogo_lock:
+        produto = _catalogo_por_id.get(str(produto_id))
+    return dict(produto) if produto else None
+
+def get_produto_por_codigo(codigo, filial_id):
+    """Retorna produto pelo código (consulta ao índice em memória)"""
+    _garantir_catalogo()
+    with _catalogo_lock:
+        produto = _catalogo_por_codigo.get((filial_id, codigo))
+    return dict(produto) if produto else None
 
 def remover_produtos(produto_ids):
     """Remove produtos e suas movimentações"""
@@ -262,11 +1124,15 @@ def remover_produtos(produto_ids):
         placeholders = ','.join([f':id_{i}' for i in range(len(produto_ids))])
         params = {f'id_{i}': produto_id for i, produto_id in enumerate(produto_ids)}
         
-        conn.execute(text(f"""
+        result = conn.execute(text(f"""
             DELETE FROM produtos 
             WHERE id IN ({placeholders})
+            RETURNING id, filial_id
         """), params)
+        removidos = result.fetchall()
+        evento = _notificar(conn, 'produtos_removidos', [r[1] for r in removidos], [r[0] for r in removidos])
         conn.commit()
+    _aplicar_evento(evento)
 
 def remover_movimentacoes(movimentacao_ids):
     """Remove movimentações específicas"""
@@ -275,8 +1141,487 @@ def remover_movimentacoes(movimentacao_ids):
         placeholders = ','.join([f':id_{i}' for i in range(len(movimentacao_ids))])
         params = {f'id_{i}': mov_id for i, mov_id in enumerate(movimentacao_ids)}
         
-        conn.execute(text(f"""
+        result = conn.execute(text(f"""
             DELETE FROM movimentacoes 
             WHERE id IN ({placeholders})
+            RETURNING produto_id, filial_id, data_movimentacao
         """), params)
-        conn.commit()
\ No newline at end of file
+        removidas = result.fetchall()
+        # Reprocessa cada produto apenas a partir da movimentação removida mais antiga
+        inicios = {}
+        for produto_id, _, data_movimentacao in removidas:
+            if produto_id not in inicios or data_movimentacao < inicios[produto_id]:
+                inicios[produto_id] = data_movimentacao
+        _recalcular_custos(conn, inicios)
+        evento = _notificar(conn, 'movimentacoes_removidas', [r[1] for r in removidas], [r[0] for r in removidas])
+        conn.commit()
+    _aplicar_evento(evento)
+
+COLUNAS_CONTAGEM = [
+    'produto_id', 'codigo', 'nome', 'quantidade_sistema', 'quantidade_contada',
+    'diferenca', 'custo_medio', 'valor_ajuste'
+]
+
+def _calcular_diferencas_contagem(conn, filial_id, contagem, zerar_nao_contados):
+    """Carrega a folha de contagem em tabela temporária e calcula as diferenças (sem commit)
+    
+    contagem: DataFrame ou lista de dicionários com 'codigo' e 'quantidade'.
+    Códigos repetidos são somados (o mesmo produto contado em vários locais).
+    """
+    if isinstance(contagem, pd.DataFrame):
+        contagem = contagem.to_dict('records')
+    quantidades = []
+    for item in contagem:
+        # int() truncaria contagens fracionárias (10.7 viraria 10) e lançaria ajustes errados
+        try:
+            quantidade = Decimal(str(item['quantidade']).strip())
+        except InvalidOperation:
+            quantidade = None
+        if quantidade is None or not quantidade.is_finite() or quantidade != quantidade.to_integral_value():
+            raise ValueError(f"Quantidade contada deve ser um número inteiro (código {item['codigo']}: {item['quantidade']})")
+        if quantidade < 0:
+            raise ValueError("Quantidade contada não pode ser negativa")
+        quantidades.append(int(quantidade))
+    
+    conn.execute(text("""
+        CREATE TEMP TABLE contagem_itens (
+            codigo VARCHAR(50) PRIMARY KEY,
+            quantidade_contada BIGINT NOT NULL
+        ) ON COMMIT DROP
+    """))
+    conn.execute(text("""
+        INSERT INTO contagem_itens (codigo, quantidade_contada)
+        SELECT codigo, SUM(quantidade)
+        FROM unnest(CAST(:codigos AS VARCHAR[]), CAST(:quantidades AS BIGINT[])) AS c(codigo, quantidade)
+        GROUP BY codigo
+    """), {
+        "codigos": [str(item['codigo']).strip() for item in contagem],
+        "quantidades": quantidades
+    })
+    
+    # Produtos fora da folha entram com contagem zero apenas se solicitado
+    nao_contados = """
+        UNION ALL
+        SELECT p.id, p.codigo, p.nome, 0
+        FROM produtos p
+        WHERE p.filial_id = :filial_id
+          AND NOT EXISTS (SELECT 1 FROM contagem_itens ci WHERE ci.codigo = p.codigo)
+    """ if zerar_nao_contados else ""
+    
+    conn.execute(text(f"""
+        CREATE TEMP TABLE contagem_diferencas ON COMMIT DROP AS
+        SELECT 
+            t.produto_id,
+            t.codigo,
+            t.nome,
+            COALESCE(c.quantidade, 0) as quantidade_sistema,
+            t.quantidade_contada,
+            t.quantidade_contada - COALESCE(c.quantidade, 0) as diferenca,
+            COALESCE(c.custo_medio, p.valor) as custo_medio,
+            (t.quantidade_contada - COALESCE(c.quantidade, 0)) * COALESCE(c.custo_medio, p.valor) as valor_ajuste
+        FROM (
+            SELECT p.id as produto_id, ci.codigo, p.nome, ci.quantidade_contada
+            FROM contagem_itens ci
+            LEFT JOIN produtos p ON p.codigo = ci.codigo AND p.filial_id = :filial_id
+            {nao_contados}
+        ) t
+        LEFT JOIN produtos p ON p.id = t.produto_id
+        LEFT JOIN custos_produtos c ON c.produto_id = t.produto_id
+    """), {"filial_id": filial_id})
+
+def previsualizar_contagem(filial_id, contagem, zerar_nao_contados=False):
+    """Compara a folha de contagem com o estoque atual da filial, sem gravar nada
+    
+    Retorna um DataFrame com uma linha por código; produto_id vazio indica
+    código não cadastrado na filial.
+    """
+    engine = get_engine()
+    with engine.connect() as conn:
+        _calcular_diferencas_contagem(conn, filial_id, contagem, zerar_nao_contados)
+        result = conn.execute(text("""
+            SELECT produto_id, codigo, nome, quantidade_sistema, quantidade_contada,
+                   diferenca, custo_medio, valor_ajuste
+            FROM contagem_diferencas
+            ORDER BY ABS(COALESCE(valor_ajuste, 0)) DESC, codigo
+        """))
+        df = pd.DataFrame(result.fetchall(), columns=COLUNAS_CONTAGEM)
+        conn.rollback()
+    return df
+
+def aplicar_contagem(filial_id, contagem, setor='Inventário', observacao=None, zerar_nao_contados=False):
+    """Lança em uma única transação os ajustes de uma contagem física e retorna o id da contagem
+    
+    Cada diferença vira uma Entrada ou Saída marcada com contagem_id. As entradas usam o
+    custo médio atual, de modo que o ajuste muda a quantidade sem alterar o custo médio.
+    """
+    contagem_id = gerar_uuid7()
+    engine = get_engine()
+    with engine.connect() as conn:
+        # Trava os razões da filial: movimentações concorrentes esperam o fim da contagem
+        produto_ids = [r[0] for r in conn.execute(text("""
+            SELECT id FROM produtos WHERE filial_id = :filial_id
+        """), {"filial_id": filial_id}).fetchall()]
+        _garantir_razao(conn, produto_ids)
+        _bloquear_razoes(conn, produto_ids)
+        
+        _calcular_diferencas_contagem(conn, filial_id, contagem, zerar_nao_contados)
+        
+        resumo = conn.execute(text("""
+            SELECT COUNT(*), COUNT(*) FILTER (WHERE produto_id IS NOT NULL AND diferenca <> 0)
+            FROM contagem_diferencas
+        """)).fetchone()
+        data_contagem = _agora_banco(conn)
+        
+        conn.execute(text("""
+            INSERT INTO contagens_inventario (id, filial_id, itens_contados, ajustes, observacao, data_contagem)
+            VALUES (:id, :filial_id, :itens, :ajustes, :observacao, :data_contagem)
+        """), {
+            "id": contagem_id,
+            "filial_id": filial_id,
+            "itens": resumo[0],
+            "ajustes": resumo[1],
+            "observacao": observacao,
+            "data_contagem": data_contagem
+        })
+        
+        ajustados = conn.execute(text("""
+            INSERT INTO movimentacoes (id, produto_id, tipo, quantidade, setor, observacao, filial_id,
+                                       data_movimentacao, custo_unitario, contagem_id,
+                                       saldo_quantidade, saldo_custo_medio, saldo_valor)
+            SELECT uuid_v7(), produto_id,
+                   CASE WHEN diferenca > 0 THEN 'Entrada' ELSE 'Saída' END,
+                   ABS(diferenca), :setor, :observacao, :filial_id, :data_contagem,
+                   CASE WHEN diferenca > 0 THEN custo_medio END,
+                   :contagem_id,
+                   quantidade_contada, custo_medio,
+                   CASE WHEN quantidade_contada > 0 THEN quantidade_contada * custo_medio ELSE 0 END
+            FROM contagem_diferencas
+            WHERE produto_id IS NOT NULL AND diferenca <> 0
+            RETURNING produto_id, id
+        """), {
+            "setor": setor,
+            "observacao": observacao or f"Ajuste de inventário (contagem {contagem_id})",
+            "filial_id": filial_id,
+            "data_contagem": data_contagem,
+            "contagem_id": contagem_id
+        }).fetchall()
+        
+        # Razões com movimentação na mesma data ou futura precisam ser reconstruídos;
+        # os demais vão direto ao saldo contado
+        retroativos = {r[0]: data_contagem for r in conn.execute(text("""
+            SELECT c.produto_id
+            FROM custos_produtos c
+            JOIN contagem_diferencas d ON d.produto_id = c.produto_id
+            WHERE d.diferenca <> 0 AND c.ultima_movimentacao >= :data_contagem
+        """), {"data_contagem": data_contagem}).fetchall()}
+        
+        conn.execute(text("""
+            UPDATE custos_produtos c
+            SET quantidade = d.quantidade_contada,
+                valor_total = CASE WHEN d.quantidade_contada > 0 THEN d.quantidade_contada * c.custo_medio ELSE 0 END,
+                ultima_movimentacao = :data_contagem,
+                ultima_movimentacao_id = a.movimentacao_id
+            FROM contagem_diferencas d
+            JOIN unnest(CAST(:produto_ids AS UUID[]), CAST(:movimentacao_ids AS UUID[]))
+                AS a(produto_id, movimentacao_id) ON a.produto_id = d.produto_id
+            WHERE d.produto_id = c.produto_id
+              AND (c.ultima_movimentacao IS NULL OR c.ultima_movimentacao < :data_contagem)
+        """), {
+            "data_contagem": data_contagem,
+            "produto_ids": [str(r[0]) for r in ajustados],
+            "movimentacao_ids": [str(r[1]) for r in ajustados]
+        })
+        
+        if retroativos:
+            _recalcular_custos(conn, retroativos)
+        
+        evento = _notificar(conn, 'contagem_aplicada', [filial_id], [r[0] for r in ajustados])
+        conn.commit()
+    _aplicar_evento(evento)
+    return contagem_id
+
+def recalcular_relatorios(dias_consumo=365, dias_baixo_giro=90):
+    """Recalcula os relatórios gerenciais (valorização, curva ABC e baixo giro) em uma transação"""
+    gerado_em = agora_local()
+    engine = get_engine()
+    with engine.connect() as conn:
+        # Uma única varredura de movimentacoes alimenta os três relatórios
+        conn.execute(text("""
+            CREATE TEMP TABLE saldos_relatorio ON COMMIT DROP AS
+            SELECT 
+                produto_id,
+                SUM(CASE WHEN tipo = 'Entrada' THEN quantidade ELSE -quantidade END) as quantidade_atual,
+                SUM(CASE WHEN tipo = 'Saída' AND data_movimentacao >= :inicio_consumo 
+                         THEN quantidade ELSE 0 END) as quantidade_consumida,
+                MAX(data_movimentacao) FILTER (WHERE tipo = 'Saída') as ultima_saida
+            FROM movimentacoes
+            GROUP BY produto_id
+        """), {"inicio_consumo": gerado_em - timedelta(days=dias_consumo)})
+        
+        conn.execute(text("DELETE FROM relatorio_valorizacao"))
+        conn.execute(text("""
+            INSERT INTO relatorio_valorizacao (filial_id, produtos, quantidade_total, valor_total, gerado_em)
+            SELECT 
+                f.id,
+                COUNT(p.id),
+                COALESCE(SUM(c.quantidade), 0),
+                COALESCE(SUM(c.valor_total), 0),
+                :gerado_em
+            FROM filiais f
+            LEFT JOIN produtos p ON p.filial_id = f.id
+            LEFT JOIN custos_produtos c ON c.produto_id = p.id
+            GROUP BY f.id
+        """), {"gerado_em": gerado_em})
+        
+        conn.execute(text("DELETE FROM relatorio_curva_abc"))
+        conn.execute(text("""
+            WITH consumo AS (
+                SELECT p.id as produto_id, p.filial_id, s.quantidade_consumida,
+                       s.quantidade_consumida * COALESCE(c.custo_medio, p.valor) as valor_consumo
+                FROM saldos_relatorio s
+                JOIN produtos p ON p.id = s.produto_id
+                LEFT JOIN custos_produtos c ON c.produto_id = p.id
+                WHERE s.quantidade_consumida > 0
+            ),
+            acumulado AS (
+                SELECT *,
+                       100.0 * SUM(valor_consumo) OVER (
+                           PARTITION BY filial_id ORDER BY valor_consumo DESC, produto_id
+                           ROWS UNBOUNDED PRECEDING
+                       ) / NULLIF(SUM(valor_consumo) OVER (PARTITION BY filial_id), 0) as percentual_acumulado,
+                       -- Participação acumulada antes do item: o item que cruza 80% ainda é A
+                       100.0 * COALESCE(SUM(valor_consumo) OVER (
+                           PARTITION BY filial_id ORDER BY valor_consumo DESC, produto_id
+                           ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                       ), 0) / NULLIF(SUM(valor_consumo) OVER (PARTITION BY filial_id), 0) as percentual_anterior
+                FROM consumo
+            )
+            INSERT INTO relatorio_curva_abc (produto_id, filial_id, quantidade_consumida, valor_consumo,
+                                             percentual_acumulado, classe, gerado_em)
+            SELECT 
+                produto_id, filial_id, quantidade_consumida, valor_consumo,
+                COALESCE(percentual_acumulado, 100),
+                CASE WHEN percentual_anterior < 80 THEN 'A'
+                     WHEN percentual_anterior < 95 THEN 'B'
+                     ELSE 'C' END,
+                :gerado_em
+            FROM acumulado
+        """), {"gerado_em": gerado_em})
+        
+        conn.execute(text("DELETE FROM relatorio_baixo_giro"))
+        conn.execute(text("""
+            INSERT INTO relatorio_baixo_giro (produto_id, filial_id, quantidade_atual, valor_parado, ultima_saida, gerado_em)
+            SELECT p.id, p.filial_id, s.quantidade_atual, COALESCE(c.valor_total, 0), s.ultima_saida, :gerado_em
+            FROM saldos_relatorio s
+            JOIN produtos p ON p.id = s.produto_id
+            LEFT JOIN custos_produtos c ON c.produto_id = p.id
+            WHERE s.quantidade_atual > 0
+              AND (s.ultima_saida IS NULL OR s.ultima_saida < :limite_giro)
+        """), {"gerado_em": gerado_em, "limite_giro": gerado_em - timedelta(days=dias_baixo_giro)})
+        
+        conn.commit()
+    return gerado_em
+
+def get_relatorio_valorizacao():
+    """Retorna a valorização do estoque por filial (pré-calculada)"""
+    engine = get_engine()
+    with engine.connect() as conn:
+        result = conn.execute(text("""
+            SELECT r.filial_id, f.nome as filial_nome, r.produtos, r.quantidade_total, r.valor_total, r.gerado_em
+            FROM relatorio_valorizacao r
+            JOIN filiais f ON f.id = r.filial_id
+            ORDER BY r.filial_id
+        """))
+        return pd.DataFrame(result.fetchall(), columns=[
+            'filial_id', 'filial_nome', 'produtos', 'quantidade_total', 'valor_total', 'gerado_em'
+        ])
+
+def get_relatorio_curva_abc(filial_id=None):
+    """Retorna a curva ABC por valor de consumo (pré-calculada)"""
+    engine = get_engine()
+    with engine.connect() as conn:
+        result = conn.execute(text("""
+            SELECT r.produto_id, p.codigo, p.nome, r.filial_id, r.quantidade_consumida,
+                   r.valor_consumo, r.percentual_acumulado, r.classe, r.gerado_em
+            FROM relatorio_curva_abc r
+            JOIN produtos p ON p.id = r.produto_id
+            WHERE CAST(:filial_id AS INTEGER) IS NULL OR r.filial_id = :filial_id
+            ORDER BY r.filial_id, r.percentual_acumulado
+        """), {"filial_id": filial_id})
+        return pd.DataFrame(result.fetchall(), columns=[
+            'produto_id', 'codigo', 'nome', 'filial_id', 'quantidade_consumida',
+            'valor_consumo', 'percentual_acumulado', 'classe', 'gerado_em'
+        ])
+
+def get_relatorio_baixo_giro(filial_id=None):
+    """Retorna os produtos parados (sem saída recente) pré-calculados"""
+    engine = get_engine()
+    with engine.connect() as conn:
+        result = conn.execute(text("""
+            SELECT r.produto_id, p.codigo, p.nome, r.filial_id, r.quantidade_atual,
+                   r.valor_parado, r.ultima_saida, r.gerado_em
+            FROM relatorio_baixo_giro r
+            JOIN produtos p ON p.id = r.produto_id
+            WHERE CAST(:filial_id AS INTEGER) IS NULL OR r.filial_id = :filial_id
+            ORDER BY r.valor_parado DESC
+        """), {"filial_id": filial_id})
+        return pd.DataFrame(result.fetchall(), columns=[
+            'produto_id', 'codigo', 'nome', 'filial_id', 'quantidade_atual',
+            'valor_parado', 'ultima_saida', 'gerado_em'
+        ])
+
+
+def migrar_ids_uuid7(tamanho_lote=5000):
+    """Reescreve como UUIDv7 os ids antigos (gen_random_uuid) de produtos e movimentações
+    
+    O timestamp de cada id vem de data_cadastro / data_movimentacao, preservando a ordem
+    histórica. As chaves estrangeiras para produtos passam a usar ON UPDATE CASCADE e a
+    migração percorre a chave primária em lotes com commit, podendo ser interrompida e
+    retomada. As respostas guardadas em chaves_idempotencia citam os ids antigos e são
+    descartadas; rode com a API de ingestão parada (ela também guarda respostas em memória).
+    Depois de migrar, um REINDEX fora do horário de uso recompacta os índices.
+    """
+    engine = get_engine()
+    totais = {'produtos': 0, 'movimentacoes': 0}
+    
+    with engine.connect() as conn:
+        # Chaves estrangeiras que apontam para produtos(id) precisam acompanhar a troca
+        restricoes = conn.execute(text("""
+            SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE confrelid = 'produtos'::regclass AND contype = 'f'
+        """)).fetchall()
+        for tabela, nome, definicao in restricoes:
+            if 'ON UPDATE CASCADE' not in definicao:
+                conn.execute(text(
+                    f'ALTER TABLE {tabela} DROP CONSTRAINT "{nome}", '
+                    f'ADD CONSTRAINT "{nome}" {definicao} ON UPDATE CASCADE'
+                ))
+        conn.commit()
+        
+        for tabela, coluna_data, extra in (
+            ('produtos', 'data_cadastro', ''),
+            # Os novos ids mudam a ordem de movimentações com a mesma data: os saldos
+            # gravados deixam de valer e são reconstruídos ao final
+            ('movimentacoes', 'data_movimentacao', ', saldo_quantidade = NULL')
+        ):
+            # Percorre a chave primária em ordem (keyset): cada lote continua de onde o
+            # anterior parou, sem varrer de novo as linhas já migradas
+            ultimo_id = '00000000-0000-0000-0000-000000000000'
+            while ultimo_id is not None:
+                # Versão do UUID é o 13º dígito hexadecimal (posição 15 no texto com hífens)
+                ultimo_id, migrados = conn.execute(text(f"""
+                    WITH lote AS (
+                        SELECT id FROM {tabela}
+                        WHERE id > CAST(:ultimo_id AS UUID)
+                        ORDER BY id
+                        LIMIT :tamanho_lote
+                    ),
+                    migrados AS (
+                        UPDATE {tabela} t
+                        SET id = uuid_v7(COALESCE(t.{coluna_data}, CURRENT_TIMESTAMP)){extra}
+                        FROM lote
+                        WHERE t.id = lote.id AND substring(t.id::text, 15, 1) <> '7'
+                        RETURNING 1
+                    )
+                    SELECT (SELECT id FROM lote ORDER BY id DESC LIMIT 1),
+                           (SELECT COUNT(*) FROM migrados)
+                """), {"ultimo_id": ultimo_id, "tamanho_lote": tamanho_lote}).fetchone()
+                conn.commit()
+                totais[tabela] += migrados
+        
+        # Reenvios de chaves antigas devolveriam ids que não existem mais
+        conn.execute(text("DELETE FROM chaves_idempotencia"))
+        evento = _notificar(conn, 'ids_migrados', [])
+        conn.commit()
+    _aplicar_evento(evento)
+    
+    # Saldos das movimentações migradas foram descartados: reconstruir em lotes
+    reconstruir_razao()
+    return totais
+
+def razao_pendente():
+    """Indica se há movimentações sem saldo gravado (executar reconstruir_razao)"""
+    engine = get_engine()
+    with engine.connect() as conn:
+        return conn.execute(text("""
+            SELECT EXISTS (SELECT 1 FROM movimentacoes WHERE saldo_quantidade IS NULL)
+        """)).scalar()
+
+def reconstruir_razao(tamanho_lote=200, todos=False):
+    """Reconstrói o razão de custo em lotes de produtos, com commit a cada lote
+    
+    Tarefa de manutenção (python database_standalone.py reconstruir-razao): cria o
+    razão dos produtos que ainda não têm um e refaz o histórico dos produtos com
+    movimentações sem saldo gravado; com todos=True refaz todos os produtos. Cada
+    lote trava apenas os razões dos seus produtos e a tarefa pode ser interrompida
+    e retomada. Retorna o número de produtos reconstruídos.
+    """
+    if todos:
+        consulta = """
+            SELECT id FROM produtos
+            WHERE id > CAST(:ultimo_id AS UUID)
+            ORDER BY id
+            LIMIT :tamanho_lote
+        """
+    else:
+        consulta = """
+            SELECT DISTINCT produto_id FROM movimentacoes
+            WHERE saldo_quantidade IS NULL AND produto_id > CAST(:ultimo_id AS UUID)
+            ORDER BY produto_id
+            LIMIT :tamanho_lote
+        """
+    
+    total = 0
+    engine = get_engine()
+    with engine.connect() as conn:
+        # Produtos sem razão começam pelo valor cadastrado; o histórico entra nos lotes abaixo
+        conn.execute(text("""
+            INSERT INTO custos_produtos (produto_id, custo_medio)
+            SELECT id, valor FROM produtos
+            ON CONFLICT (produto_id) DO NOTHING
+        """))
+        conn.commit()
+        
+        ultimo_id = '00000000-0000-0000-0000-000000000000'
+        while True:
+            produto_ids = [r[0] for r in conn.execute(text(consulta), {
+                "ultimo_id": ultimo_id,
+                "tamanho_lote": tamanho_lote
+            }).fetchall()]
+            if not produto_ids:
+                break
+            _recalcular_custos(conn, {produto_id: None for produto_id in produto_ids})
+            conn.commit()
+            total += len(produto_ids)
+            ultimo_id = str(produto_ids[-1])
+        
+        evento = _notificar(conn, 'razao_reconstruido', [])
+        conn.commit()
+    _aplicar_evento(evento)
+    return total
+
+if __name__ == "__main__":
+    import argparse
+    from dotenv import load_dotenv
+    
+    load_dotenv()
+    DATABASE_URL = os.getenv('DATABASE_URL')
+    
+    parser = argparse.ArgumentParser(description="Manutenção do banco do controle de estoque")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+    p_migrar = subparsers.add_parser("migrar-uuid7", help="Converte ids antigos para UUIDv7")
+    p_migrar.add_argument("--lote", type=int, default=5000, help="Registros por commit (padrão: 5000)")
+    p_razao = subparsers.add_parser("reconstruir-razao", help="Reconstrói o razão de custo médio a partir do histórico")
+    p_razao.add_argument("--lote", type=int, default=200, help="Produtos por commit (padrão: 200)")
+    p_razao.add_argument("--todos", action="store_true", help="Refaz todos os produtos, não só os pendentes")
+    args = parser.parse_args()
+    
+    if args.comando == "migrar-uuid7":
+        init_database()
+        totais = migrar_ids_uuid7(args.lote)
+        print(f"Ids migrados: {totais['produtos']} produtos, {totais['movimentacoes']} movimentações")
+    elif args.comando == "reconstruir-razao":
+        init_database()
+        total = reconstruir_razao(args.lote, args.todos)
+        print(f"Razão de custo reconstruído para {total} produtos")
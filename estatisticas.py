@@ -0,0 +1,9 @@
+"""Funções estatísticas compartilhadas pelas ferramentas de teste de carga."""
+
+
+def percentil(valores, p):
+    """Percentil p (0-100) de uma lista já ordenada"""
+    if not valores:
+        return 0.0
+    indice = min(len(valores) - 1, int(round(p / 100 * (len(valores) - 1))))
+    return valores[indice]
@@ -0,0 +1,70 @@
+"""Worker de relatórios gerenciais.
+
+Recalcula em segundo plano a valorização do estoque, a curva ABC e os
+produtos de baixo giro, gravando o resultado nas tabelas relatorio_*.
+A interface apenas lê essas tabelas, sem varrer movimentacoes.
+
+Uso:
+    python worker_relatorios.py                  # a cada 15 minutos e a cada alteração
+    python worker_relatorios.py --uma-vez        # recalcula uma vez e sai
+    python worker_relatorios.py --intervalo 300 --espera 30
+"""
+import argparse
+import threading
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Carregar variáveis de ambiente antes de importar a camada de dados
+load_dotenv()
+
+from database_standalone import (
+    init_database, iniciar_listener, registrar_ouvinte, recalcular_relatorios
+)
+
+
+def executar(intervalo, espera, ouvir_alteracoes, dias_consumo, dias_baixo_giro):
+    """Loop principal: recalcula no intervalo configurado ou logo após uma alteração"""
+    alteracao = threading.Event()
+
+    if ouvir_alteracoes:
+        registrar_ouvinte(lambda payload: alteracao.set())
+        iniciar_listener()
+
+    while True:
+        inicio = time.monotonic()
+        try:
+            gerado_em = recalcular_relatorios(dias_consumo, dias_baixo_giro)
+            print(f"[{gerado_em:%d/%m/%Y %H:%M:%S}] Relatórios recalculados em {time.monotonic() - inicio:.1f}s", flush=True)
+        except Exception as e:
+            print(f"[{datetime.now():%d/%m/%Y %H:%M:%S}] Erro ao recalcular relatórios: {e}", flush=True)
+
+        alteracao.wait(intervalo)
+        if alteracao.is_set():
+            # Agrupa rajadas de movimentações em um único recálculo
+            time.sleep(espera)
+            alteracao.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcula os relatórios gerenciais do estoque")
+    parser.add_argument("--uma-vez", action="store_true", help="Recalcula uma vez e sai")
+    parser.add_argument("--intervalo", type=float, default=900, help="Segundos entre recálculos (padrão: 900)")
+    parser.add_argument("--espera", type=float, default=60, help="Segundos aguardados após uma alteração antes de recalcular (padrão: 60)")
+    parser.add_argument("--sem-notificacoes", action="store_true", help="Não recalcula ao receber alterações, apenas no intervalo")
+    parser.add_argument("--dias-consumo", type=int, default=365, help="Janela de consumo da curva ABC em dias (padrão: 365)")
+    parser.add_argument("--dias-baixo-giro", type=int, default=90, help="Dias sem saída para considerar baixo giro (padrão: 90)")
+    args = parser.parse_args()
+
+    init_database()
+
+    if args.uma_vez:
+        gerado_em = recalcular_relatorios(args.dias_consumo, args.dias_baixo_giro)
+        print(f"Relatórios recalculados em {gerado_em:%d/%m/%Y %H:%M:%S}")
+        return
+
+    executar(args.intervalo, args.espera, not args.sem_notificacoes, args.dias_consumo, args.dias_baixo_giro)
+
+
+if __name__ == "__main__":
+    main()